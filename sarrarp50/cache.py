@@ -0,0 +1,45 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
+
+
+class ReferenceCache:
+    # On-disk cache of decoded reference files. Reference files do not change
+    # between evaluations, so segmentation masks and action files are decoded
+    # once and stored as compressed numpy arrays. Entries are keyed by the
+    # absolute path, size and modification time of the source file, so a
+    # modified reference file is decoded again.
+
+    def __init__(self, root_dir):
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+
+    def entry_path(self, filepath):
+        filepath = Path(filepath).resolve()
+        stat = filepath.stat()# raises FileNotFoundError if the reference file is missing
+        key = f'{filepath}:{stat.st_size}:{stat.st_mtime_ns}'
+        return self.root_dir/(hashlib.sha1(key.encode()).hexdigest()+'.npz')
+
+    def load(self, filepath, decode):
+        # returns the cached array of filepath, decode(filepath) is called to
+        # create the entry if it is not in the cache
+        entry = self.entry_path(filepath)
+        try:
+            with np.load(entry) as data:
+                return data['data']
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            pass
+        arr = decode(filepath)
+        # write to a temporary file first so concurrent evaluations never read
+        # a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.root_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, data=arr)
+            os.replace(tmp_path, entry)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return arr
@@ -0,0 +1,70 @@
+import io
+from pathlib import Path
+import numpy as np
+
+
+# Lossless formats frames and segmentation masks can be stored in. png is the
+# format of the SAR-RARP50 dataset. webp is written in lossless mode, npy stores
+# the raw uint8 array, which is the fastest to write and read (memory mapped)
+# at the cost of disk space.
+# opencv is only imported by the functions that encode or decode images, it is
+# slow to import and not needed to parse the command line of rarptk.
+FRAME_FORMATS = {'png': '.png', 'webp': '.webp', 'npy': '.npy'}
+FRAME_SUFFIXES = set(FRAME_FORMATS.values())
+
+
+def frame_path(filepath, fmt='png'):
+    # appends the suffix of fmt to filepath
+    filepath = Path(filepath)
+    return filepath.with_name(filepath.name+FRAME_FORMATS[fmt])
+
+
+def encode_frame(img, fmt='png', png_compression=None):
+    # returns the bytes of img stored in format fmt, the same bytes write_frame writes.
+    # png_compression is the zlib compression level (0-9) of png files, opencv's
+    # default is used if it is not set.
+    if fmt == 'npy':
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(img, dtype=np.uint8))
+        return buffer.getvalue()
+    import cv2
+    params = []
+    if fmt == 'png' and png_compression is not None:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    elif fmt == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, 101]# quality above 100 selects lossless encoding
+    ok, buffer = cv2.imencode(FRAME_FORMATS[fmt], img, params)
+    if not ok:
+        raise ValueError(f'could not encode frame as {fmt}')
+    return buffer.tobytes()
+
+
+def write_frame(filepath, img, fmt='png', png_compression=None):
+    # writes img to filepath with the suffix of fmt and returns the written path
+    filepath = frame_path(filepath, fmt)
+    with open(filepath, 'wb') as f:
+        f.write(encode_frame(img, fmt, png_compression))
+    return filepath
+
+
+def read_frame(filepath):
+    # reads a frame written by write_frame, or any image opencv can decode. Returns
+    # None if the file does not exist, same as cv2.imread. npy files are memory mapped.
+    filepath = Path(filepath)
+    if filepath.suffix == '.npy':
+        try:
+            return np.load(filepath, mmap_mode='r')
+        except FileNotFoundError:
+            return None
+    import cv2
+    return cv2.imread(str(filepath))
+
+
+def frame_paths(directory):
+    # maps the stem of every frame file under directory to its path, so frames can be
+    # matched by name independently of the format they are stored in. Empty if the
+    # directory does not exist.
+    try:
+        return {p.stem: p for p in Path(directory).iterdir() if p.suffix in FRAME_SUFFIXES}
+    except FileNotFoundError:
+        return {}
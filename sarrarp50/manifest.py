@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import numpy as np
+
+
+# The evaluation manifest is stored in the prediction directory and records the
+# content hash of every scored file together with the scores computed from it.
+# Incremental evaluations only rescore the files whose hash changed.
+MANIFEST_NAME = 'evaluation_manifest.json'
+MANIFEST_VERSION = 1
+
+
+def file_hash(filepath, chunk_size=1<<20):
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_record(filepath, previous=None):
+    # returns the size, modification time and content hash of filepath, or None if
+    # it does not exist. The hash of the previous record is reused if the size and
+    # modification time did not change, so unchanged files are not read.
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    if previous is not None and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        return dict(previous)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': file_hash(filepath)}
+
+
+def array_record(arr, mtime_ns, previous=None):
+    # same as file_record for a frame of a packed container (sarrarp50.packed).
+    # mtime_ns is the modification time of the container, the hash of the previous
+    # record is reused if the container did not change.
+    if arr is None:
+        return None
+    if previous is not None and previous['size'] == arr.nbytes and previous['mtime_ns'] == mtime_ns:
+        return dict(previous)
+    return {'size': arr.nbytes, 'mtime_ns': mtime_ns, 'sha1': hashlib.sha1(np.ascontiguousarray(arr)).hexdigest()}
+
+
+def same_content(record_a, record_b):
+    if record_a is None or record_b is None:
+        return record_a is None and record_b is None
+    return record_a['sha1'] == record_b['sha1']
+
+
+def video_hash(frame_records):
+    # combines the hashes of all the frames of a video into one hash
+    sha1 = hashlib.sha1()
+    for name in sorted(frame_records):
+        for record in (frame_records[name]['ref'], frame_records[name]['pred']):
+            sha1.update(f"{name}:{record['sha1'] if record else None};".encode())
+    return sha1.hexdigest()
+
+
+def load_manifest(prediction_dir, settings):
+    # returns the per-video entries of the manifest stored in prediction_dir. No
+    # entries are returned if there is no manifest or if it was created with
+    # different scoring settings.
+    try:
+        with open(Path(prediction_dir)/MANIFEST_NAME) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('settings') != settings:
+        return {}
+    return manifest.get('videos', {})
+
+
+def save_manifest(prediction_dir, settings, videos):
+    manifest = {'version': MANIFEST_VERSION, 'settings': settings, 'videos': videos}
+    # write to a temporary file first so an interrupted evaluation never leaves
+    # a partially written manifest behind
+    tmp_path = Path(prediction_dir)/(MANIFEST_NAME+'.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, Path(prediction_dir)/MANIFEST_NAME)
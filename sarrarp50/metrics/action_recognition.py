@@ -1,15 +1,21 @@
 import numpy as np
 import warnings
+from functools import lru_cache
+from pathlib import Path
+from sarrarp50 import profiling
+
+def segment_starts(Yi):
+    # index of the first frame of every run of identical labels
+    Yi = np.asarray(Yi)
+    return np.flatnonzero(np.r_[True, Yi[1:] != Yi[:-1]])
 
 def segment_labels(Yi):
-    idxs = [0] + (np.nonzero(np.diff(Yi))[0] + 1).tolist() + [len(Yi)]
-    Yi_split = np.array([Yi[idxs[i]] for i in range(len(idxs) - 1)])
-    return Yi_split
+    return np.asarray(Yi)[segment_starts(Yi)]
     
 def segment_intervals(Yi):
-    idxs = [0] + (np.nonzero(np.diff(Yi))[0] + 1).tolist() + [len(Yi)]
-    intervals = [(idxs[i], idxs[i + 1]) for i in range(len(idxs) - 1)]
-    return intervals
+    # returns a (n_segments, 2) array of [start, end) frame intervals
+    starts = segment_starts(Yi)
+    return np.stack([starts, np.r_[starts[1:], len(Yi)]], axis=1)
 
 
 def _accuracy(P, Y, **kwargs):
@@ -21,79 +27,292 @@ def _accuracy(P, Y, **kwargs):
         return acc_(P,Y)
 
 
-def _f1k(P, Y, n_classes=0, bg_class=None, overlap=.1, **kwargs):
-    def overlap_(p,y, n_classes, bg_class, overlap):
+def _segment_matches(p, y, bg_class=None):
+    # Finds the true segment every predicted segment is compared against in the
+    # greedy matching of _f1k: the overlapping true segment with the same label
+    # and the highest IoU, the first one in case of ties. Both label sequences
+    # partition the same frames into segments, so the overlapping segment pairs
+    # are the pieces of the common refinement of the two partitions and there are
+    # at most n_pred + n_true of them.
+    # returns the number of predicted and true segments, and for every predicted
+    # segment with a match, the index of the matched true segment and their IoU
+    p_intervals, p_labels = segment_intervals(p), segment_labels(p)
+    y_intervals, y_labels = segment_intervals(y), segment_labels(y)
+    if bg_class is not None:
+        n_pred = np.count_nonzero(p_labels != bg_class)
+        n_true = np.count_nonzero(y_labels != bg_class)
+    else:
+        n_pred, n_true = len(p_labels), len(y_labels)
+    return (n_pred, n_true, *_match_segments(p_intervals, p_labels, y_intervals, y_labels, bg_class))
+
+
+def _match_segments(p_intervals, p_labels, y_intervals, y_labels, bg_class=None):
+    # the matching of _segment_matches, given the segments of both partitions.
+    # returns the index of the matched true segment and the IoU of every
+    # predicted segment with a match
+    pieces = np.union1d(p_intervals[:,0], y_intervals[:,0])
+    p_idx = np.searchsorted(p_intervals[:,0], pieces, side='right') - 1
+    y_idx = np.searchsorted(y_intervals[:,0], pieces, side='right') - 1
+
+    # only segments with the same label are candidates, background segments are ignored
+    keep = p_labels[p_idx] == y_labels[y_idx]
+    if bg_class is not None:
+        keep &= p_labels[p_idx] != bg_class
+    p_idx, y_idx = p_idx[keep], y_idx[keep]
+
+    p_int, y_int = p_intervals[p_idx], y_intervals[y_idx]
+    intersection = np.minimum(p_int[:,1], y_int[:,1]) - np.maximum(p_int[:,0], y_int[:,0])
+    union = np.maximum(p_int[:,1], y_int[:,1]) - np.minimum(p_int[:,0], y_int[:,0])
+    IoU = intersection / union
+
+    # sort by predicted segment, then by decreasing IoU and increasing true segment
+    # index, the first pair of every predicted segment is its best match
+    order = np.lexsort((y_idx, -IoU, p_idx))
+    p_idx, y_idx, IoU = p_idx[order], y_idx[order], IoU[order]
+    first = np.ones(len(p_idx), dtype=bool)
+    first[1:] = p_idx[1:] != p_idx[:-1]
+    return y_idx[first], IoU[first]
+
+
+def _f1_from_matches(n_pred, n_true, match_idx, match_IoU, overlap):
+    # A predicted segment is a true positive if its matched true segment has
+    # IoU >= overlap and was not used by a previous predicted segment. Every true
+    # segment can be used once, so the number of true positives is the number of
+    # true segments whose best match has IoU >= overlap. overlap can be a single
+    # threshold or an array of thresholds, in which case an array of F1 scores
+    # is returned.
+    # best IoU every true segment got matched with, -inf if it was never matched
+    true_IoU = np.full(match_idx.max(initial=-1)+1, -np.inf)
+    np.maximum.at(true_IoU, match_idx, match_IoU)
+    true_IoU.sort()
+    TP = (true_IoU.size - np.searchsorted(true_IoU, overlap, side='left')).astype(np.float64)
+    FP = n_pred - TP
+    # False negatives are any unused true segment (i.e. "miss")
+    FN = n_true - TP
 
-        true_intervals = np.array(segment_intervals(y))
-        true_labels = segment_labels(y)
-        pred_intervals = np.array(segment_intervals(p))
-        pred_labels = segment_labels(p)
-
-        # Remove background labels
-        if bg_class is not None:
-            true_intervals = true_intervals[true_labels!=bg_class]
-            true_labels = true_labels[true_labels!=bg_class]
-            pred_intervals = pred_intervals[pred_labels!=bg_class]
-            pred_labels = pred_labels[pred_labels!=bg_class]
-
-        n_true = true_labels.shape[0]
-        n_pred = pred_labels.shape[0]
-
-        # We keep track of the per-class TP, and FP.
-        # In the end we just sum over them though.
-        TP = np.zeros(n_classes, np.float)
-        FP = np.zeros(n_classes, np.float)
-        true_used = np.zeros(n_true, np.float)
-
-        for j in range(n_pred):
-            # Compute IoU against all others
-            intersection = np.minimum(pred_intervals[j,1], true_intervals[:,1]) - np.maximum(pred_intervals[j,0], true_intervals[:,0])
-            union = np.maximum(pred_intervals[j,1], true_intervals[:,1]) - np.minimum(pred_intervals[j,0], true_intervals[:,0])
-            IoU = (intersection / union)*(pred_labels[j]==true_labels)
-
-            # Get the best scoring segment
-            idx = IoU.argmax()
-
-            # If the IoU is high enough and the true segment isn't already used
-            # Then it is a true positive. Otherwise is it a false positive.
-            if IoU[idx] >= overlap and not true_used[idx]:
-                TP[pred_labels[j]] += 1
-                true_used[idx] = 1
-            else:
-                FP[pred_labels[j]] += 1
-
-        TP = TP.sum()
-        FP = FP.sum()
-        # False negatives are any unused true segment (i.e. "miss")
-        FN = n_true - true_used.sum()
-        
+    with np.errstate(divide='ignore', invalid='ignore'):
         precision = TP / (TP+FP)
         recall = TP / (TP+FN)
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            F1 = 2 * (precision*recall) / (precision+recall)
+        F1 = 2 * (precision*recall) / (precision+recall)
+
+    # If the prec+recall=0, it is a NaN. Set these to 0.
+    return np.nan_to_num(F1)
 
-        # If the prec+recall=0, it is a NaN. Set these to 0.
-        F1 = np.nan_to_num(F1)
 
-        return F1
+def _f1k(P, Y, n_classes=0, bg_class=None, overlap=.1, **kwargs):
+    # segmental F1 score with greedy matching of predicted to true segments.
+    # The matching runs in O((n_pred+n_true)log(n_pred+n_true)) and gives the same
+    # scores as comparing every predicted segment against all true segments,
+    # for any overlap > 0.
+    def overlap_(p,y, n_classes, bg_class, overlap):
+        return _f1_from_matches(*_segment_matches(p, y, bg_class), overlap)
 
     if type(P) == list:
         return np.mean([overlap_(P[i],Y[i], n_classes, bg_class, overlap) for i in range(len(P))])
     else:
         return overlap_(P, Y, n_classes, bg_class, overlap)
+
+
+def _f1k_curve(P, Y, overlaps, n_classes=0, bg_class=None, **kwargs):
+    # segmental F1 scores for multiple overlap thresholds, 0 < overlap <= 1.
+    # Segments and their matches are computed once and shared between all thresholds.
+    overlaps = np.asarray(overlaps, dtype=np.float64)
+    def curve_(p, y):
+        return _f1_from_matches(*_segment_matches(p, y, bg_class), overlaps)
+
+    if type(P) == list:
+        return np.mean([curve_(P[i], Y[i]) for i in range(len(P))], axis=0)
+    else:
+        return curve_(P, Y)
     
     
     
-def accuracy(pred_dir, ref_dir):
-    ref_action = np.genfromtxt(ref_dir/'action_discrete.txt', delimiter=',')
-    pred_action = np.genfromtxt(pred_dir/'action_discrete.txt', delimiter=',')
-    return _accuracy(pred_action[:,1],ref_action[:,1])
+_INT32 = np.iinfo(np.int32)
+
+def parse_action_file(filepath):
+    # parses an action_discrete.txt file, where each line follows the frame_id,label
+    # format, and returns a (n_lines, 2) int32 array. Empty lines are skipped.
+    # A ValueError listing the line numbers of all malformed lines is raised if the
+    # file does not follow the format. Values that do not fit in an int32 are malformed.
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")# numpy warns about empty files
+            # parsed as int64 first, int32 parsing silently wraps large values
+            action = np.loadtxt(filepath, delimiter=',', dtype=np.int64, ndmin=2)
+        if action.size == 0:
+            return np.zeros((0, 2), dtype=np.int32)
+        if action.shape[1] == 2 and action.min() >= _INT32.min and action.max() <= _INT32.max:
+            return action.astype(np.int32)
+    except (ValueError, OverflowError):
+        pass
+
+    # find the malformed lines to report them
+    malformed = []
+    with open(filepath, 'rb') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            fields = line.split(b',')
+            try:
+                if len(fields) != 2:
+                    raise ValueError
+                if not all(_INT32.min <= int(field) <= _INT32.max for field in fields):
+                    raise ValueError
+            except ValueError:
+                malformed.append(f'line {line_no}: {line.decode(errors="replace").strip()!r}')
+    raise ValueError(f"{filepath} does not follow the frame_id,label format. Malformed lines: {', '.join(malformed)}")
+
+# the files of one evaluation, reference and prediction of every video, fit in the
+# cache. It is bounded so long running processes do not keep every file they read
+@lru_cache(maxsize=256)
+def _read_action_file(filepath, size, mtime_ns):
+    with profiling.stage('parse_actions', nbytes=size) as s:
+        action = parse_action_file(filepath)
+        s.count(frames=len(action))
+    # the array is shared by all callers, do not allow modifying it
+    action.setflags(write=False)
+    return action
+
+def read_action_file(filepath):
+    # reads action_discrete.txt files. Each file is parsed once per process and the
+    # parsed array is shared between file validation and all metrics. Files are
+    # identified by their path, size and modification time.
+    filepath = Path(filepath).resolve()
+    stat = filepath.stat()
+    return _read_action_file(filepath, stat.st_size, stat.st_mtime_ns)
+
+def read_ref_action_file(filepath, ref_cache=None):
+    # reference action files can be read through a sarrarp50.cache.ReferenceCache
+    if ref_cache is not None:
+        return np.asarray(ref_cache.load(filepath, read_action_file), dtype=np.int32)
+    return read_action_file(filepath)
+    
+def as_action_labels(pred, ref):
+    # converts in-memory per-frame action labels to int32 arrays. pred and ref are
+    # either the label sequences of one video, or lists with one sequence per video
+    # in which case scores are averaged over the videos, like the file based metrics.
+    if type(pred) == list or type(ref) == list:
+        if len(pred) != len(ref):
+            raise ValueError(f'got action labels of {len(pred)} predicted and {len(ref)} reference videos')
+        pairs = [as_action_labels(p, r) for p, r in zip(pred, ref)]
+        return [p for p, _ in pairs], [r for _, r in pairs]
+    pred, ref = np.asarray(pred, dtype=np.int32).reshape(-1), np.asarray(ref, dtype=np.int32).reshape(-1)
+    if len(pred) != len(ref):
+        raise ValueError(f'got {len(pred)} predicted and {len(ref)} reference action labels')
+    return pred, ref
+
+# In-memory counterparts of accuracy, f1k and f1k_curve, for scoring action labels
+# without writing them to disk. The file based functions load the labels and call these.
+
+def accuracy_from_labels(pred, ref):
+    return _accuracy(*as_action_labels(pred, ref))
+
+def f1k_from_labels(pred, ref, k=10, n_classes=8):
+    return _f1k(*as_action_labels(pred, ref), n_classes=n_classes, overlap=k/100)
+
+def f1k_curve_from_labels(pred, ref, ks=(10, 25, 50), n_classes=8):
+    # returns an array with the F1@k score of every k in ks, 0 < k <= 100
+    return _f1k_curve(*as_action_labels(pred, ref), np.asarray(ks)/100, n_classes=n_classes)
+
+def concat_segments(labels, starts):
+    # run-length encoding of the concatenated label sequence of several videos.
+    # starts are the indices of the first frame of every non-empty video, where
+    # a new segment starts even if the label does not change. returns the
+    # [start, end) intervals and the labels of the segments
+    new_segment = np.r_[True, labels[1:] != labels[:-1]][:len(labels)]
+    new_segment[starts] = True
+    seg_starts = np.flatnonzero(new_segment)
+    seg_ends = np.r_[seg_starts[1:], len(labels)][:len(seg_starts)]
+    return np.stack([seg_starts, seg_ends], axis=1), labels[seg_starts]
+
+
+def score_action_set(preds, refs, ks=(10,), n_classes=8, bg_class=None):
+    # Scores the action labels of a whole test set at once. preds and refs are
+    # lists with the per-frame labels of every video. The label sequences of all
+    # videos are concatenated and scored in vectorized passes, segments are
+    # split at the video boundaries so they never span two videos.
+    # returns a dict with
+    #   accuracy: (n_videos,) frame accuracy of every video
+    #   f1: (n_videos, len(ks)) F1@k score of every video and k in ks, 0 < k <= 100
+    #   confusion: (n_videos, n_classes, n_classes) frame confusion matrix of
+    #     every video, rows correspond to reference and columns to predicted labels
+    # The scores of every video are identical to accuracy_from_labels and
+    # f1k_curve_from_labels. Labels must be in the [0, n_classes) range.
+    preds, refs = list(preds), list(refs)
+    if len(preds) != len(refs):
+        raise ValueError(f'got action labels of {len(preds)} predicted and {len(refs)} reference videos')
+    pairs = [as_action_labels(np.asarray(p), np.asarray(r)) for p, r in zip(preds, refs)]
+    preds, refs = [p for p, _ in pairs], [r for _, r in pairs]
+    n_videos = len(refs)
+    lengths = np.array([len(y) for y in refs], dtype=np.intp)
+    offsets = np.r_[0, np.cumsum(lengths)]
+    P = np.concatenate(preds) if n_videos else np.zeros(0, dtype=np.int32)
+    Y = np.concatenate(refs) if n_videos else np.zeros(0, dtype=np.int32)
+    if len(Y) and (min(P.min(), Y.min()) < 0 or max(P.max(), Y.max()) >= n_classes):
+        raise ValueError(f'action labels must be in the [0, {n_classes}) range')
+    video = np.repeat(np.arange(n_videos), lengths)
+
+    # accuracy and confusion matrices from the frames of all videos
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accuracy = np.bincount(video[P == Y], minlength=n_videos) / lengths
+    confusion = np.bincount((video*n_classes + Y)*n_classes + P, minlength=n_videos*n_classes*n_classes)
+    confusion = confusion.reshape(n_videos, n_classes, n_classes)
+
+    # segments of all videos, see _segment_matches for the matching
+    starts = offsets[:-1][lengths > 0]
+    p_intervals, p_labels = concat_segments(P, starts)
+    y_intervals, y_labels = concat_segments(Y, starts)
+    p_video, y_video = video[p_intervals[:,0]], video[y_intervals[:,0]]
+    # number of predicted and true segments of every video, background segments are ignored
+    p_counted = p_labels != bg_class if bg_class is not None else slice(None)
+    y_counted = y_labels != bg_class if bg_class is not None else slice(None)
+    n_pred = np.bincount(p_video[p_counted], minlength=n_videos)[:,None]
+    n_true = np.bincount(y_video[y_counted], minlength=n_videos)[:,None]
+    match_idx, match_IoU = _match_segments(p_intervals, p_labels, y_intervals, y_labels, bg_class)
+
+    # best IoU every true segment got matched with, see _f1_from_matches
+    true_IoU = np.full(len(y_labels), -np.inf)
+    np.maximum.at(true_IoU, match_idx, match_IoU)
+    overlaps = np.asarray(ks, dtype=np.float64)/100
+    TP = np.stack([np.bincount(y_video, weights=true_IoU >= overlap, minlength=n_videos)
+                   for overlap in overlaps], axis=1)
+    FP = n_pred - TP
+    FN = n_true - TP
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = TP / (TP+FP)
+        recall = TP / (TP+FN)
+        F1 = 2 * (precision*recall) / (precision+recall)
+    return {'accuracy': accuracy, 'f1': np.nan_to_num(F1).reshape(n_videos, len(overlaps)), 'confusion': confusion}
+
+
+def confusion_stats(confusion):
+    # per-class frame statistics of a (n_classes, n_classes) confusion matrix with
+    # reference labels as rows. returns a dict of (n_classes,) arrays
+    confusion = np.asarray(confusion)
+    tp = np.diag(confusion).astype(np.float64)
+    support, predicted = confusion.sum(axis=1), confusion.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = tp / predicted
+        recall = tp / support
+        f1 = 2*tp / (support + predicted)
+        iou = tp / (support + predicted - tp)
+    return {'support': support, 'predicted': predicted, 'precision': precision,
+            'recall': recall, 'f1': f1, 'iou': iou}
+
+def accuracy(pred_dir, ref_dir, ref_cache=None):
+    ref_action = read_ref_action_file(ref_dir/'action_discrete.txt', ref_cache)
+    pred_action = read_action_file(pred_dir/'action_discrete.txt')
+    return accuracy_from_labels(pred_action[:,1],ref_action[:,1])
     
     # check if they have the same length and if they do not 
 
-def f1k(pred_dir, ref_dir, k=10, n_classes=8):
-    ref_action = np.genfromtxt(ref_dir/'action_discrete.txt', delimiter=',').astype(int)
-    pred_action = np.genfromtxt(pred_dir/'action_discrete.txt', delimiter=',').astype(int)
-    return _f1k(pred_action[:,1],ref_action[:,1], n_classes=n_classes, overlap=k/100)
-    
\ No newline at end of file
+def f1k(pred_dir, ref_dir, k=10, n_classes=8, ref_cache=None):
+    ref_action = read_ref_action_file(ref_dir/'action_discrete.txt', ref_cache)
+    pred_action = read_action_file(pred_dir/'action_discrete.txt')
+    return f1k_from_labels(pred_action[:,1],ref_action[:,1], k=k, n_classes=n_classes)
+
+def f1k_curve(pred_dir, ref_dir, ks=(10, 25, 50), n_classes=8, ref_cache=None):
+    # returns an array with the F1@k score of every k in ks, 0 < k <= 100
+    ref_action = read_ref_action_file(ref_dir/'action_discrete.txt', ref_cache)
+    pred_action = read_action_file(pred_dir/'action_discrete.txt')
+    return f1k_curve_from_labels(pred_action[:,1],ref_action[:,1], ks=ks, n_classes=n_classes)
@@ -0,0 +1,92 @@
+import numpy as np
+
+# Segmentation metrics computed directly on HxW uint8 label maps. They produce
+# the same per-class scores as the monai metrics used in segmentation.py without
+# expanding the masks to one-hot tensors.
+
+
+def confusion_matrix(pred, ref, n_classes):
+    # builds a n_classes x n_classes confusion matrix from two label maps using a
+    # single bincount. Rows correspond to reference and columns to predicted labels.
+    if pred.shape != ref.shape:
+        raise ValueError(f'prediction and reference masks have different shapes {pred.shape}!={ref.shape}')
+    idx = ref.reshape(-1).astype(np.intp) * n_classes + pred.reshape(-1)
+    cm = np.bincount(idx, minlength=n_classes*n_classes)
+    if cm.size > n_classes*n_classes or pred.max(initial=0) >= n_classes:
+        raise ValueError(f'segmentation masks contain labels outside of the [0, {n_classes}) range')
+    return cm.reshape(n_classes, n_classes)
+
+
+def iou_from_confusion(cm, include_background=False):
+    # computes per-class IoU from a confusion matrix following the conventions of
+    # monai.metrics.MeanIoU(ignore_empty=False): classes missing from both the
+    # reference and the prediction score 1. Computation happens in float32 to
+    # match the monai one-hot path.
+    intersection = np.diag(cm).astype(np.float32)
+    union = (cm.sum(axis=0) + cm.sum(axis=1)).astype(np.float32) - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(union > 0, intersection / union, np.float32(1))
+    if not include_background:
+        iou = iou[1:]
+    return iou.reshape(1, -1)
+
+
+def label_map_iou(n_classes, include_background=False):
+    # returns a function that computes the per-class IoU of a pair of label maps
+    def f(pred, ref):
+        return iou_from_confusion(confusion_matrix(pred, ref, n_classes), include_background)
+    return f
+
+
+# cross shaped structuring element, same as the scipy.ndimage.binary_erosion
+# default used by monai to extract mask edges and cv2.getStructuringElement(cv2.MORPH_CROSS, (3,3))
+_CROSS = np.array([[0,1,0], [1,1,1], [0,1,0]], dtype=np.uint8)
+
+def mask_edges(mask):
+    # returns the boundary pixels of a binary uint8 mask, the pixels that get
+    # removed when eroding it with a zero border.
+    import cv2# opencv is slow to import, only load it when masks are scored
+    eroded = cv2.erode(mask, _CROSS, borderType=cv2.BORDER_CONSTANT, borderValue=0)
+    return (mask ^ eroded).astype(bool)
+
+
+def surface_dice(pred_mask, ref_mask, tau):
+    # computes the NSD of two non-empty binary uint8 masks. Both masks are cropped
+    # to the bounding box of their union, padded by one pixel so erosion on the
+    # crop is identical to erosion on the full image. All edge pixels lie inside
+    # the crop, so the distance transforms computed on it are exact.
+    from scipy.ndimage import distance_transform_edt# scipy is slow to import
+    union = pred_mask | ref_mask
+    rows = np.flatnonzero(union.any(axis=1))
+    cols = np.flatnonzero(union.any(axis=0))
+    y0, y1 = max(rows[0]-1, 0), rows[-1]+2
+    x0, x1 = max(cols[0]-1, 0), cols[-1]+2
+    pred_edges = mask_edges(pred_mask[y0:y1, x0:x1])
+    ref_edges = mask_edges(ref_mask[y0:y1, x0:x1])
+
+    dist_pred_ref = distance_transform_edt(~ref_edges)[pred_edges]
+    dist_ref_pred = distance_transform_edt(~pred_edges)[ref_edges]
+    boundary_correct = np.sum(dist_pred_ref <= tau) + np.sum(dist_ref_pred <= tau)
+    boundary_complete = len(dist_pred_ref) + len(dist_ref_pred)
+    return boundary_correct / boundary_complete
+
+
+def label_map_nsd(n_classes, channel_tau, include_background=False):
+    # returns a function that computes the per-class NSD of a pair of label maps.
+    # channel_tau holds one threshold per scored class. Empty classes follow the
+    # rules applied to monai.metrics.SurfaceDiceMetric in segmentation.py: 1 if
+    # the class is missing from both masks and 0 if it is missing from only one.
+    first_class = 0 if include_background else 1
+    def f(pred, ref):
+        pred_count = np.bincount(pred.reshape(-1), minlength=n_classes)
+        ref_count = np.bincount(ref.reshape(-1), minlength=n_classes)
+        if pred_count.size > n_classes or ref_count.size > n_classes:
+            raise ValueError(f'segmentation masks contain labels outside of the [0, {n_classes}) range')
+        nsd = np.zeros(n_classes - first_class, dtype=np.float32)
+        for i, c in enumerate(range(first_class, n_classes)):
+            if pred_count[c] == 0 and ref_count[c] == 0:
+                nsd[i] = 1
+            elif pred_count[c] > 0 and ref_count[c] > 0:
+                nsd[i] = surface_dice((pred == c).view(np.uint8), (ref == c).view(np.uint8), channel_tau[i])
+        return nsd.reshape(1, -1)
+    return f
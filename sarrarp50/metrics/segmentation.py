@@ -1,91 +1,377 @@
-import torch
-import monai
-import cv2
+import os
+import sys
 from pathlib import Path
 import numpy as np
 import warnings
+import concurrent.futures as cf
+from collections import deque
+from contextlib import nullcontext
+from sarrarp50.metrics.label_map import label_map_iou, label_map_nsd
+from sarrarp50.metrics.stats import ClassScoreAccumulator
+from sarrarp50.image_io import read_frame, frame_paths
+from sarrarp50.packed import load_packed
+from sarrarp50 import profiling
 
 
 def save_one_hot(root_dir, oh):
     # function to sotre a one hot tensor as separate images 
+    import cv2
     for i, c in enumerate(oh):
         print(c.numpy().shape)
         cv2.imwrite(f'{root_dir}/{i}.png', c.numpy().astype(np.uint8)*255)
     exit()
 
-def imread_one_hot(filepath, n_classes):
-    # reads a segmentation mask stored as png and returns in in one-hot torch.tensor format
-    img = cv2.imread(str(filepath))
+def imread_label(filepath):
+    # reads a segmentation mask stored in any of sarrarp50.image_io.FRAME_FORMATS
+    # and returns it as a HxW uint8 label map
+    img = read_frame(filepath)
     if img is None:
         raise FileNotFoundError (filepath)
     if len(img.shape)==3:# if the segmentation mask was 3 channel, only keep the first
         img = img[...,0]
-    img = torch.from_numpy(img).unsqueeze(0).unsqueeze(0).requires_grad_(False)
+    return img
+
+def to_one_hot(label, n_classes):
+    # converts a HxW label map to a (1,n_classes,H,W) one-hot torch.tensor, or a
+    # NxHxW stack of label maps to a (N,n_classes,H,W) one
+    # torch and monai are only imported by the monai backend, they are slow to import
+    import torch, monai
+    img = torch.from_numpy(label)
+    if img.ndim == 2:
+        img = img.unsqueeze(0)
+    img = img.unsqueeze(1).requires_grad_(False)
     return monai.networks.utils.one_hot(img, n_classes, dim=1)
 
+def imread_one_hot(filepath, n_classes):
+    # reads a segmentation mask stored as png and returns in in one-hot torch.tensor format
+    return to_one_hot(imread_label(filepath), n_classes)
+
+
+def is_label_map_metric(metric):
+    # monai metrics operate on one-hot tensors, every other metric is expected to
+    # operate directly on HxW label maps. If monai was never imported, the metric
+    # cannot be a monai metric.
+    monai = sys.modules.get('monai')
+    return monai is None or not isinstance(metric, monai.metrics.Metric)
+
+
+def frame_scores(metric, pred, ref, fix_nans=False):
+    # computes the per-class scores of a single pair of segmentation masks
+    # pred and ref are label maps for label map metrics and one-hot tensors otherwise
+    return batch_scores(metric, pred, ref, fix_nans)[0]
+
+
+def batch_scores(metric, pred, ref, fix_nans=False):
+    # computes the per-class scores of a batch of segmentation masks and returns
+    # one list of scores per frame. pred and ref are (N,C,H,W) one-hot tensors
+    # for monai metrics, which are called once for the whole batch. Label map
+    # metrics get a single HxW label map pair.
+    if is_label_map_metric(metric):
+        # label map metrics already handle empty classes
+        return [np.asarray(metric(pred, ref)).reshape(-1).tolist()]
+    if fix_nans:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            err = metric(pred, ref)
+        # if both reference and predictions are zero, set the prediciton values to one
+        # this is required for NSD because otherise values are goint to
+        # be set to nan even though the prediciton is correct.
+        # in case either the pred or corresponding ref channel is zero
+        # NSD will resurn either 0 or nan and in those cases nan is 
+        # converted to zero
+        # find the zero channels in both ref and pred and create a mask 
+        # in the size of the final prediction.(Nxn_channels)
+        r_m, p_m = ref.mean(axis=(2,3)), pred.mean(axis=(2,3))
+        mask = ((r_m ==0) * (p_m == 0))[:,1:]
+
+        # set the scores in cases where both ref and pred were full zero
+        #  to 1.
+        err[mask==True]=1
+        # in cases where either was full zero but the other wasn't 
+        # (score is nan ) set the corresponding score to 0
+        err.nan_to_num_()
+    else:
+        err = metric(pred, ref)
+    return err.detach().reshape(len(err), -1).tolist()
+
 
+def _source_bytes(source):
+    # bytes read to load a mask file or a frame of a packed container, for profiling
+    if isinstance(source, np.ndarray):
+        return source.nbytes
+    try:
+        return os.stat(source).st_size
+    except FileNotFoundError:
+        return 0
 
-def get_val_func(metric, n_classes=9, fix_nans=False):
+
+def metric_name(metric):
+    # stage name of a metric in profiling reports, the class name of monai metrics
+    # and the name of the function that created label map metrics
+    if hasattr(metric, '__qualname__'):
+        return metric.__qualname__.split('.<locals>')[0]
+    return type(metric).__name__
+
+
+def read_label_pair(name, ref, pred, ref_cache=None, downscale=1):
+    # returns (name, prediction label map, reference label map). ref and pred are
+    # either the path of a mask file, which is decoded, or a label map of a packed
+    # container (sarrarp50.packed), which is used without copying.
+    # pred is None if pred is None or the prediction file was not found.
+    # With downscale > 1 only every downscale-th pixel in each direction is kept
+    # (nearest neighbour downsampling, which never mixes labels).
+    with profiling.stage('decode', frames=1) as s:
+        if s:
+            s.count(nbytes=_source_bytes(ref) + (_source_bytes(pred) if pred is not None else 0))
+        if not isinstance(ref, np.ndarray):
+            ref = ref_cache.load(ref, imread_label) if ref_cache is not None else imread_label(ref)
+        try:
+            if pred is not None and not isinstance(pred, np.ndarray):
+                pred = imread_label(pred)
+        except FileNotFoundError:
+            pred = None
+    if downscale > 1:
+        ref = np.ascontiguousarray(ref[::downscale, ::downscale])
+        pred = np.ascontiguousarray(pred[::downscale, ::downscale]) if pred is not None else None
+    return name, pred, ref
+
+
+def iter_label_pairs(dir_pred, dir_ref, ref_cache=None, decode_workers=0, prefetch=None,
+                     downscale=1, frame_step=1, frames=None):
+    # yields (frame name, prediction label map, reference label map) for every
+    # reference mask under dir_ref, in sorted order. With decode_workers > 0 masks
+    # are decoded by a thread pool ahead of the consumer. At most prefetch pairs
+    # (2*decode_workers by default) are decoded or waiting to be consumed at any
+    # time, which bounds memory use. opencv releases the GIL while decoding, so
+    # decoding overlaps with the metric computation. 
+    # frame_step > 1 only yields every frame_step-th reference frame, and
+    # downscale > 1 subsamples the masks, see read_label_pair. Both are meant
+    # for fast approximate scoring. If frames is given, only reference frames
+    # with those file names are yielded.
+    # Predictions are matched to reference masks by file stem, so they can be
+    # stored in any of sarrarp50.image_io.FRAME_FORMATS. If dir_ref or dir_pred
+    # has an up to date packed container, masks are read from it instead.
+    ref_packed, pred_packed = load_packed(dir_ref), load_packed(dir_pred)
+    if ref_packed is not None:
+        names = sorted(ref_packed.names)[::frame_step]
+    else:
+        names = [p.name for p in sorted(Path(dir_ref).iterdir())][::frame_step]
+    if frames is not None:
+        frames = set(frames)
+        names = [n for n in names if n in frames]
+    pred_paths = frame_paths(dir_pred) if pred_packed is None else None
+
+    def sources(name):
+        # the arguments of read_label_pair for frame name
+        ref = ref_packed.get(name) if ref_packed is not None else Path(dir_ref)/name
+        pred = pred_packed.get(name) if pred_packed is not None else pred_paths.get(Path(name).stem)
+        return name, ref, pred, ref_cache, downscale
+
+    if decode_workers <= 0:
+        for name in names:
+            yield read_label_pair(*sources(name))
+        return
+
+    prefetch = max(prefetch or 2*decode_workers, 1)
+    with cf.ThreadPoolExecutor(max_workers=decode_workers) as pool:
+        pending = deque()
+        for name in names:
+            pending.append(pool.submit(read_label_pair, *sources(name)))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_fused_score_func(metrics, n_classes=9, fix_nans=None, accumulate=False, batch_size=1):
+    # returns a function that scores an iterable of (frame name, prediction label
+    # map, reference label map) tuples with every metric and returns one score
+    # array per metric, with one row per frame in iteration order. A frame with a
+    # None prediction scores zero for every class, same as a missing prediction file.
+    # If accumulate is set, per-frame scores are folded into a 
+    # sarrarp50.metrics.stats.ClassScoreAccumulator per metric as they are 
+    # computed and the accumulators are returned instead of the score arrays.
+    # monai metrics are computed on batches of up to batch_size frames stacked
+    # into (N,C,H,W) tensors. Scores are the same for every batch size, larger
+    # batches reduce per-call overhead at the cost of memory.
+    fix_nans = [False]*len(metrics) if fix_nans is None else fix_nans
+    # masks are only expanded to one-hot tensors if a monai metric needs them
+    need_one_hot = not all(is_label_map_metric(m) for m in metrics)
+    names = [metric_name(m) for m in metrics]
+    def f(pairs):
+        if accumulate:
+            acc=[ClassScoreAccumulator(n_classes) for _ in metrics]
+        else:
+            acc=[[] for _ in metrics]
+        batch = []
+        def score_batch():
+            # scores the frames in batch and appends the scores to acc
+            if not batch:
+                return
+            preds, refs = [p for p, _ in batch], [r for _, r in batch]
+            if need_one_hot:
+                with profiling.stage('one_hot', frames=len(batch)):
+                    pred_oh = to_one_hot(np.stack(preds), n_classes+1)
+                    ref_oh = to_one_hot(np.stack(refs), n_classes+1)
+            for a, metric, name, fix in zip(acc, metrics, names, fix_nans):
+                with profiling.stage(name, frames=len(batch)):
+                    if is_label_map_metric(metric):
+                        rows = [frame_scores(metric, p, r, fix) for p, r in batch]
+                    else:
+                        rows = batch_scores(metric, pred_oh, ref_oh, fix)
+                for row in rows:
+                    a.append(row)
+            batch.clear()
+
+        # gradients are disabled for the tensors of the monai metrics
+        with (sys.modules['torch'].no_grad() if need_one_hot else nullcontext()):
+            for _, pred, ref in pairs:
+                if pred is None:
+                    # score the previous frames first to keep the order of the scores 
+                    score_batch()
+                    # if the prediciton file was not found, set all scores to zero and continue
+                    for a in acc:
+                        a.append([0]*n_classes) 
+                    continue
+                batch.append((pred, ref))
+                if len(batch) >= batch_size:
+                    score_batch()
+            score_batch()
+        if accumulate:
+            return tuple(acc)
+        return tuple(np.array(a) for a in acc)# need to add axis and then multiply with the channel scales
+    return f
+
+
+def get_fused_val_func(metrics, n_classes=9, fix_nans=None, ref_cache=None, accumulate=False,
+                       decode_workers=0, prefetch=None, batch_size=1, downscale=1, frame_step=1,
+                       frames=None):
+    # same as get_val_func but for multiple metrics. Each reference and prediction
+    # mask is read and converted to one-hot format once, and all metrics are
+    # computed on the same tensors. The returned function returns one score array
+    # per metric. The masks are loaded by iter_label_pairs and scored by
+    # get_fused_score_func, see there for accumulate and batch_size. 
+    # If a sarrarp50.cache.ReferenceCache is given, reference masks
+    # are read through it instead of decoding the png files.
+    # decode_workers and prefetch control decoding masks in background threads,
+    # see iter_label_pairs. Frames are always scored in sorted order.
+    # downscale and frame_step enable approximate scoring on subsampled masks
+    # and frames, see iter_label_pairs. Exact scoring is the default.
+    # frames restricts scoring to the reference frames with the given file names.
+    # Masks are read from packed containers when they exist, see iter_label_pairs.
+    score = get_fused_score_func(metrics, n_classes, fix_nans, accumulate, batch_size)
+    def f(dir_pred, dir_ref):
+        # segmentation masks are loaded as label maps
+        return score(iter_label_pairs(dir_pred, dir_ref, ref_cache, decode_workers, prefetch,
+                                      downscale, frame_step, frames))
+    return f
+
+
+def get_val_func(metric, n_classes=9, fix_nans=False, **kwargs):
     # this function is intented for wrapping the meanIoU and meanNSD metric computation functions
     # It returns a error computation function that is able to parse reference 
     # and prediction segmentaiton samples in directory level. 
+    # kwargs are forwarded to get_fused_val_func
+    fused = get_fused_val_func([metric], n_classes=n_classes, fix_nans=[fix_nans], **kwargs)
     def f(dir_pred, dir_ref):
-        seg_ref_paths = sorted(list(dir_ref.iterdir()))
-        dir_pred = Path(dir_pred)
-        
-        acc=[]
-        with torch.no_grad():
-            for seg_ref_p in seg_ref_paths:
-
-                # load segmentation masks as one_hot torch tensors
-                try:
-                    ref = imread_one_hot(seg_ref_p, n_classes=n_classes+1)
-                except FileNotFoundError:
-                    raise
-                try:
-                    pred = imread_one_hot(dir_pred/seg_ref_p.name, n_classes=n_classes+1)
-                except FileNotFoundError as e:
-                    # if the prediciton file was not found, set all scores to zero and continue
-                    acc.append([0]*n_classes) 
-                    continue
-                
-                
-                if fix_nans:
-                    with warnings.catch_warnings():
-                        warnings.simplefilter("ignore")
-                        err = metric(pred, ref)
-                    # if both reference and predictions are zero, set the prediciton values to one
-                    # this is required for NSD because otherise values are goint to
-                    # be set to nan even though the prediciton is correct.
-                    # in case either the pred or corresponding ref channel is zero
-                    # NSD will resurn either 0 or nan and in those cases nan is 
-                    # converted to zero
-                    # find the zero channels in both ref and pred and create a mask 
-                    # in the size of the final prediction.(1xn_channels)
-                    r_m, p_m = ref.mean(axis=(2,3)), pred.mean(axis=(2,3))
-                    mask = ((r_m ==0) * (p_m == 0))[:,1:]
-
-                    # set the scores in cases where both ref and pred were full zero
-                    #  to 1.
-                    err[mask==True]=1
-                    # in cases where either was full zero but the other wasn't 
-                    # (score is nan ) set the corresponding score to 0
-                    err.nan_to_num_()
-                else:
-                    err = metric(pred, ref)
-                acc.append(err.detach().reshape(-1).tolist())
-        return np.array(acc)# need to add axis and then multiply with the channel scales
+        return fused(dir_pred, dir_ref)[0]
     return f
+
+
+def iou_metric(n_classes=9, backend='monai'):
+    # backend='numpy' computes IoU from a confusion matrix of the label maps
+    # instead of the one-hot tensors. Both backends return the same scores.
+    if backend == 'numpy':
+        return label_map_iou(n_classes+1, include_background=False)
+    elif backend == 'monai':
+        import monai
+        return monai.metrics.MeanIoU(include_background=False, reduction='mean', get_not_nans=False, ignore_empty=False)
+    raise ValueError(f'unknown segmentation metric backend {backend}')
+
+def nsd_metric(channel_tau, n_classes=9, backend='monai'):
+    # backend='numpy' computes NSD from the class boundaries of the label maps
+    # and does not need the fix_nans post-processing.
+    if backend == 'numpy':
+        return label_map_nsd(n_classes+1, channel_tau, include_background=False)
+    elif backend == 'monai':
+        import monai
+        return monai.metrics.SurfaceDiceMetric(channel_tau,
+                                               include_background=False,
+                                               reduction='mean')
+    raise ValueError(f'unknown segmentation metric backend {backend}')
     
-def mIoU(dir_pred, dir_ref, n_classes=9):
-    metric = monai.metrics.MeanIoU(include_background=False, reduction='mean', get_not_nans=False, ignore_empty=False)
-    validation_func = get_val_func(metric, n_classes=n_classes)
+def mIoU(dir_pred, dir_ref, n_classes=9, backend='monai', **kwargs):
+    validation_func = get_val_func(iou_metric(n_classes, backend), n_classes=n_classes, **kwargs)
     return validation_func(dir_pred/'segmentation', dir_ref/'segmentation')
 
-def mNSD(dir_pred, dir_ref, n_classes = 9, channel_tau = [1]*9):
-    metric = monai.metrics.SurfaceDiceMetric(channel_tau,
-                                            include_background=False,
-                                            reduction='mean')
-    validation_func = get_val_func(metric, n_classes=n_classes, fix_nans=True)
+def scale_tau(channel_tau, downscale=1):
+    # NSD thresholds are given in full resolution pixels, scale them to the
+    # resolution of downscaled masks
+    if downscale == 1:
+        return channel_tau
+    return [tau/downscale for tau in channel_tau]
+
+def mNSD(dir_pred, dir_ref, n_classes = 9, channel_tau = [1]*9, backend='monai', **kwargs):
+    channel_tau = scale_tau(channel_tau, kwargs.get('downscale', 1))
+    validation_func = get_val_func(nsd_metric(channel_tau, n_classes, backend), n_classes=n_classes, fix_nans=True, **kwargs)
     return validation_func(dir_pred/'segmentation', dir_ref/'segmentation')
-    
+
+def mIoU_mNSD(dir_pred, dir_ref, n_classes=9, channel_tau=[1]*9, backend='monai', **kwargs):
+    # computes both mIoU and mNSD decoding every segmentation mask once.
+    # returns the per-frame per-class IoU and NSD score arrays.
+    # kwargs(ref_cache, accumulate, ...) are forwarded to get_fused_val_func
+    channel_tau = scale_tau(channel_tau, kwargs.get('downscale', 1))
+    validation_func = get_fused_val_func([iou_metric(n_classes, backend), nsd_metric(channel_tau, n_classes, backend)],
+                                         n_classes=n_classes,
+                                         fix_nans=[False, True],
+                                         **kwargs)
+    return validation_func(dir_pred/'segmentation', dir_ref/'segmentation')
+
+
+def as_label_map(label):
+    # converts an in-memory label map to the HxW uint8 array the file loader produces
+    label = np.asarray(label)
+    if label.ndim != 2:
+        raise ValueError(f'expected a HxW label map, got an array of shape {label.shape}')
+    if label.dtype != np.uint8:
+        if label.size and (label.min() < 0 or label.max() > 255):
+            raise ValueError('label maps must contain labels in the [0, 255] range')
+        label = label.astype(np.uint8)
+    return label
+
+def label_map_pairs(pred, ref=None):
+    # yields (frame name, prediction label map, reference label map) from in-memory
+    # data. Either pred is an iterable of (frame name, pred, ref) tuples, or pred and
+    # ref are (N,H,W) arrays or sequences of HxW label maps, named by their index.
+    # A None prediction is scored as a missing prediction file.
+    if ref is None:
+        items = pred
+    else:
+        if len(pred) != len(ref):
+            raise ValueError(f'got {len(pred)} prediction and {len(ref)} reference label maps')
+        items = zip(range(len(ref)), pred, ref)
+    for name, p, r in items:
+        r = as_label_map(r)
+        if p is not None:
+            p = as_label_map(p)
+            if p.shape != r.shape:
+                raise ValueError(f'prediction and reference label maps of frame {name} have different shapes {p.shape}!={r.shape}')
+        yield name, p, r
+
+# In-memory counterparts of mIoU, mNSD and mIoU_mNSD, for scoring predictions
+# without writing them to disk, e.g. in a training loop. Scores follow the same
+# rules as the file based functions, which load the masks and call the same
+# scoring code. kwargs(accumulate, batch_size) are forwarded to get_fused_score_func
+
+def mIoU_from_label_maps(pred, ref=None, n_classes=9, backend='monai', **kwargs):
+    score = get_fused_score_func([iou_metric(n_classes, backend)], n_classes=n_classes, **kwargs)
+    return score(label_map_pairs(pred, ref))[0]
+
+def mNSD_from_label_maps(pred, ref=None, n_classes=9, channel_tau=[1]*9, backend='monai', **kwargs):
+    score = get_fused_score_func([nsd_metric(channel_tau, n_classes, backend)], n_classes=n_classes, fix_nans=[True], **kwargs)
+    return score(label_map_pairs(pred, ref))[0]
+
+def mIoU_mNSD_from_label_maps(pred, ref=None, n_classes=9, channel_tau=[1]*9, backend='monai', **kwargs):
+    score = get_fused_score_func([iou_metric(n_classes, backend), nsd_metric(channel_tau, n_classes, backend)],
+                                 n_classes=n_classes, fix_nans=[False, True], **kwargs)
+    return score(label_map_pairs(pred, ref))
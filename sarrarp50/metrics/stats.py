@@ -0,0 +1,103 @@
+import numpy as np
+
+
+DESCRIBE_QUANTILES = (0.25, 0.5, 0.75)
+
+
+class ClassScoreAccumulator:
+    # Folds per-frame per-class scores into running statistics, so summaries of
+    # a video can be computed without keeping the scores of every frame in memory.
+    # Count, mean, std, min and max are exact. Quantiles are exact while at most
+    # exact_limit frames have been added. After that the buffered scores are
+    # folded into a per-class histogram with n_bins bins over [low, high] and
+    # quantiles are interpolated from it, with an error below (high-low)/n_bins.
+    # append() mirrors list.append so an accumulator can be used in place of the
+    # list of per-frame scores built by sarrarp50.metrics.segmentation.get_val_func
+
+    def __init__(self, n_classes, exact_limit=10000, n_bins=2**14, low=0., high=1.):
+        self.n_classes = n_classes
+        self.exact_limit = exact_limit
+        self.n_bins = n_bins
+        self.low, self.high = low, high
+        self.count = 0
+        self._mean = np.zeros(n_classes)
+        self._m2 = np.zeros(n_classes)
+        self._min = np.full(n_classes, np.inf)
+        self._max = np.full(n_classes, -np.inf)
+        self._frame_mean_sum = 0.
+        self._exact = []
+        self._hist = None
+
+    def append(self, scores):
+        x = np.asarray(scores, dtype=np.float64).reshape(-1)
+        self.count += 1
+        # Welford's online mean and variance
+        delta = x - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (x - self._mean)
+        np.minimum(self._min, x, out=self._min)
+        np.maximum(self._max, x, out=self._max)
+        self._frame_mean_sum += x.mean()
+
+        if self._hist is None:
+            self._exact.append(x)
+            if len(self._exact) > self.exact_limit:
+                self._hist = np.zeros((self.n_classes, self.n_bins), dtype=np.int64)
+                self._add_to_hist(np.stack(self._exact))
+                self._exact = []
+        else:
+            self._add_to_hist(x[None])
+
+    def _add_to_hist(self, x):
+        bins = ((np.clip(x, self.low, self.high) - self.low) / (self.high - self.low) * self.n_bins).astype(np.int64)
+        bins = np.minimum(bins, self.n_bins - 1)
+        for c in range(self.n_classes):
+            self._hist[c] += np.bincount(bins[:, c], minlength=self.n_bins)
+
+    def mean(self):
+        # per-class mean score
+        return self._mean.copy() if self.count else np.full(self.n_classes, np.nan)
+
+    def std(self):
+        # per-class sample standard deviation, same as pandas.DataFrame.std
+        if self.count < 2:
+            return np.full(self.n_classes, np.nan)
+        return np.sqrt(self._m2 / (self.count - 1))
+
+    def frame_mean(self):
+        # mean over frames of the per-frame mean over classes,
+        # same as np.array(scores).mean(axis=1).mean()
+        return self._frame_mean_sum / self.count if self.count else np.nan
+
+    def quantile(self, q):
+        # per-class quantile, linearly interpolated between order statistics
+        # like pandas.DataFrame.quantile
+        if self.count == 0:
+            return np.full(self.n_classes, np.nan)
+        if self._hist is None:
+            return np.quantile(np.stack(self._exact), q, axis=0)
+        pos = (self.count - 1) * q
+        k0, k1 = int(np.floor(pos)), int(np.ceil(pos))
+        v0, v1 = self._hist_order_statistic(k0), self._hist_order_statistic(k1)
+        return v0 + (v1 - v0) * (pos - k0)
+
+    def _hist_order_statistic(self, k):
+        # estimates the k-th smallest score of every class assuming scores are
+        # spread uniformly inside their bin, clipped to the observed range
+        width = (self.high - self.low) / self.n_bins
+        cum = np.cumsum(self._hist, axis=1)
+        b = np.argmax(cum > k, axis=1)
+        rows = np.arange(self.n_classes)
+        before = cum[rows, b] - self._hist[rows, b]
+        v = self.low + (b + (k - before + 0.5) / self._hist[rows, b]) * width
+        return np.clip(v, self._min, self._max)
+
+    def describe(self, columns=None):
+        # returns the same summary as pandas.DataFrame(scores, columns=columns).describe()
+        import pandas as pd
+        rows = [np.full(self.n_classes, float(self.count)), self.mean(), self.std(),
+                self._min if self.count else np.full(self.n_classes, np.nan)]
+        rows += [self.quantile(q) for q in DESCRIBE_QUANTILES]
+        rows += [self._max if self.count else np.full(self.n_classes, np.nan)]
+        index = ['count', 'mean', 'std', 'min'] + [f'{q*100:g}%' for q in DESCRIBE_QUANTILES] + ['max']
+        return pd.DataFrame(np.stack(rows), index=index, columns=columns)
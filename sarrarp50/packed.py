@@ -0,0 +1,111 @@
+import os
+import warnings
+from pathlib import Path
+import numpy as np
+from sarrarp50.image_io import FRAME_SUFFIXES
+
+
+# A packed container stores all the segmentation masks of a directory in a single
+# uint8 array of shape (n_frames,H,W), saved as <directory>_packed.npy next to the
+# directory, and the file names of the masks, one per line, in
+# <directory>_packed.txt. The array is memory mapped, so frames are read without
+# opening or decoding individual files. Every index line also holds the size and
+# modification time of the packed file, so a container is only used while the
+# masks of the directory are exactly the ones that were packed.
+
+
+def packed_paths(directory):
+    # returns the paths of the array and the index file of the container of directory
+    directory = Path(directory)
+    return (directory.with_name(directory.name+'_packed.npy'),
+            directory.with_name(directory.name+'_packed.txt'))
+
+
+class PackedFrames:
+    # read-only view of a packed container, frames are looked up by file stem so
+    # they can be matched to masks stored in other formats
+
+    def __init__(self, data, names, mtime_ns):
+        self.data = data
+        self.names = names
+        self.mtime_ns = mtime_ns
+        self._index = {Path(n).stem: i for i, n in enumerate(names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, name):
+        # returns the HxW label map of frame name, without copying it, or None
+        i = self._index.get(Path(name).stem)
+        return None if i is None else self.data[i]
+
+
+def file_stats(directory):
+    # maps the name of every frame file under directory to its (size, mtime_ns),
+    # with a single os.scandir call. None if the directory does not exist.
+    stats = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_file() and os.path.splitext(entry.name)[1] in FRAME_SUFFIXES:
+                    stat = entry.stat()
+                    stats[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return stats
+
+
+def load_packed(directory):
+    # returns the PackedFrames of directory, or None if there is no container. If
+    # directory exists, the container is ignored with a warning unless it lists
+    # exactly the mask files of directory with their current sizes and
+    # modification times (files were added, removed or rewritten after packing),
+    # so the files are read instead. Without the directory only the container is used.
+    data_p, index_p = packed_paths(directory)
+    try:
+        data_stat = os.stat(data_p)
+        with open(index_p) as f:
+            lines = [line.split() for line in f.read().splitlines() if line.strip()]
+    except FileNotFoundError:
+        return None
+    names = [line[0] for line in lines]
+    stats = file_stats(directory)
+    if stats is not None:
+        packed_stats = {line[0]: tuple(int(v) for v in line[1:3]) for line in lines if len(line) == 3}
+        if len(packed_stats) != len(lines) or packed_stats != stats:
+            warnings.warn(f'{data_p} does not match the files of {directory} and is ignored, run rarptk pack to update it')
+            return None
+    data = np.load(data_p, mmap_mode='r')
+    if data.ndim != 3 or len(data) != len(names):
+        raise ValueError(f'{data_p} contains {len(data)} frames while {index_p} lists {len(names)}')
+    return PackedFrames(data, names, data_stat.st_mtime_ns)
+
+
+def pack_frames(directory, frames, shape, stats=None):
+    # writes the container of directory. frames is an iterable of (file name,
+    # HxW uint8 label map) tuples in the order they are stored, shape is the
+    # (n_frames,H,W) shape of the container. Frames are copied into the memory
+    # mapped array one at a time, so the masks never have to fit in memory.
+    # stats are the file_stats of directory recorded in the index. They must be
+    # taken before the masks are read, they are taken when pack_frames is called
+    # if not given.
+    data_p, index_p = packed_paths(directory)
+    stats = (stats if stats is not None else file_stats(directory)) or {}
+    # write to temporary files first so an interrupted pack never leaves a
+    # partially written container behind
+    tmp_data_p, tmp_index_p = data_p.with_suffix('.npy.tmp'), index_p.with_suffix('.txt.tmp')
+    data = np.lib.format.open_memmap(tmp_data_p, mode='w+', dtype=np.uint8, shape=tuple(shape))
+    names = []
+    for i, (name, label) in enumerate(frames):
+        data[i] = label
+        names.append(name)
+    if len(names) != shape[0]:
+        raise ValueError(f'expected {shape[0]} frames for {directory}, got {len(names)}')
+    data.flush()
+    del data
+    with open(tmp_index_p, 'w') as f:
+        # frames without a file are never matched against the directory
+        f.write(''.join('{} {} {}\n'.format(name, *stats.get(name, (-1, -1))) for name in names))
+    os.replace(tmp_index_p, index_p)
+    os.replace(tmp_data_p, data_p)
+    return data_p, index_p
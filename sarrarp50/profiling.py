@@ -0,0 +1,130 @@
+import threading
+import time
+
+
+# Optional instrumentation of the evaluation stages. Code doing measurable work
+# wraps it in stage(), which reports the wall time, the number of frames and the
+# number of bytes read to every registered hook. Without hooks stage() returns a
+# shared no-op object, so instrumentation costs nothing when profiling is off.
+# Hooks are called from the thread and process that ran the stage.
+PROFILE_NAME = 'evaluation_profile.json'
+
+_hooks = []
+
+
+def add_hook(hook):
+    # hook(stage, seconds, frames, nbytes) is called after every profiled stage
+    _hooks.append(hook)
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+def enabled():
+    return bool(_hooks)
+
+
+class _NullStage:
+    # returned by stage() when profiling is off. It is falsy, so callers can
+    # skip computing frame and byte counts with `if s:`
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __bool__(self):
+        return False
+
+    def count(self, frames=0, nbytes=0):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+
+    def __init__(self, name, frames, nbytes):
+        self.name = name
+        self.frames = frames
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        for hook in list(_hooks):
+            hook(self.name, seconds, self.frames, self.nbytes)
+        return False
+
+    def count(self, frames=0, nbytes=0):
+        # adds frames and bytes that are only known once the stage ran
+        self.frames += frames
+        self.nbytes += nbytes
+
+
+def stage(name, frames=0, nbytes=0):
+    # context manager timing the stage name, see _Stage.count
+    if not _hooks:
+        return _NULL_STAGE
+    return _Stage(name, frames, nbytes)
+
+
+class StageRecorder:
+    # hook accumulating the number of calls, wall time, frames and bytes of every
+    # stage. Stages running in several threads at once add up their wall times.
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name, seconds, frames, nbytes):
+        with self._lock:
+            s = self.stages.setdefault(name, {'calls': 0, 'seconds': 0., 'frames': 0, 'bytes': 0})
+            s['calls'] += 1
+            s['seconds'] += seconds
+            s['frames'] += frames
+            s['bytes'] += nbytes
+
+    def merge(self, stages):
+        # adds the stages of another recorder, e.g. one of a worker process
+        for name, s in stages.items():
+            with self._lock:
+                t = self.stages.setdefault(name, {'calls': 0, 'seconds': 0., 'frames': 0, 'bytes': 0})
+                for key in t:
+                    t[key] += s[key]
+
+    def __enter__(self):
+        add_hook(self)
+        return self
+
+    def __exit__(self, *exc):
+        remove_hook(self)
+        return False
+
+
+def with_throughput(stages):
+    # copy of the stages of a StageRecorder with frames and MB per second
+    out = {}
+    for name, s in stages.items():
+        s = dict(s)
+        if s['seconds'] > 0 and s['frames']:
+            s['frames_per_second'] = s['frames'] / s['seconds']
+        if s['seconds'] > 0 and s['bytes']:
+            s['mb_per_second'] = s['bytes'] / s['seconds'] / 1e6
+        out[name] = s
+    return out
+
+
+def summary(stages):
+    # one line description of the stages of a StageRecorder, slowest first
+    parts = []
+    for name, s in sorted(stages.items(), key=lambda item: -item[1]['seconds']):
+        part = f"{name} {s['seconds']:.3f}s"
+        if s['frames']:
+            part += f" {s['frames']} frames"
+        if s['bytes']:
+            part += f" {s['bytes']/1e6:.1f}MB"
+        parts.append(part)
+    return ', '.join(parts)
@@ -1,8 +1,12 @@
-import cv2
+import os
+from fnmatch import fnmatch
+from functools import lru_cache
 from pathlib import Path
 import numpy as np
 import logging 
 from tqdm import tqdm 
+from sarrarp50.metrics.action_recognition import read_action_file, read_ref_action_file
+from sarrarp50.packed import load_packed
 
 
 class TqdmLoggingHandler(logging.StreamHandler):
@@ -19,79 +23,154 @@ class TqdmLoggingHandler(logging.StreamHandler):
 
 
 def video_len(video_path):
+    import cv2# opencv is slow to import
     vid = cv2.VideoCapture(str(video_path))
     n_frames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
     vid.release()
     return n_frames
 
-def reference_sequence_len(ref_dir):
+
+def scan_dir(directory):
+    # lists a directory with a single os.scandir call and returns the sets of
+    # file and sub-directory names. Both are empty if the directory does not exist
+    files, dirs = set(), set()
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                (dirs if entry.is_dir() else files).add(entry.name)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return files, dirs
+
+
+@lru_cache(maxsize=None)
+def _source_len(path, size, mtime_ns):
+    path = Path(path)
+    if path.is_dir():
+        return len(os.listdir(path))
+    return video_len(path)
+
+def source_len(path, ref_cache=None):
+    # number of frames of a video file or number of files in a directory. Results
+    # are cached in memory by path, size and modification time, and on disk if a
+    # sarrarp50.cache.ReferenceCache is given, so repeated validations of the
+    # same reference set do not open the videos again.
+    if ref_cache is not None:
+        return int(ref_cache.load(path, lambda p: np.array(source_len(p))))
+    stat = os.stat(path)
+    return _source_len(str(path), stat.st_size, stat.st_mtime_ns)
+
+
+def reference_sequence_len(ref_dir, ref_cache=None, listing=None):
+    # listing is the scan_dir result of ref_dir, if it is already available
+    files, dirs = listing if listing is not None else scan_dir(ref_dir)
     n_action_frames = n_seg_frames = None
-    if  (ref_dir/'video_left.avi').is_file():
-        n_vid_frames = video_len(ref_dir/'video_left.avi')
+    if 'video_left.avi' in files:
+        n_vid_frames = source_len(ref_dir/'video_left.avi', ref_cache)
         n_action_frames = int((n_vid_frames-1)//6)+1
         n_seg_frames = int((n_vid_frames-1)//60)+1
-    elif (ref_dir/'rgb').is_dir():
-        n_action_frames = len(list((ref_dir/'rgb').iterdir()))
+    elif 'rgb' in dirs:
+        n_action_frames = source_len(ref_dir/'rgb', ref_cache)
         n_seg_frames = ((n_action_frames-1)//10)+1
-    elif (ref_dir/'action_discrete.txt').is_file():# get number of frames from the reference action recognition file
-        with open(ref_dir/'action_discrete.txt') as ar:
-            n_action_frames = len(ar.readlines())
+    elif 'action_discrete.txt' in files:# get number of frames from the reference action recognition file
+        n_action_frames = len(read_ref_action_file(ref_dir/'action_discrete.txt', ref_cache))
         n_seg_frames = ((n_action_frames-1)//10)+1
-    elif (ref_dir/'segmentation').is_dir():
-        n_seg_frames = len(list((ref_dir/'segmentation').iterdir()))
+    elif 'segmentation' in dirs:
+        n_seg_frames = source_len(ref_dir/'segmentation', ref_cache)
+    elif 'segmentation_packed.npy' in files:
+        # None if the index of the container is missing
+        packed = load_packed(ref_dir/'segmentation')
+        n_seg_frames = len(packed) if packed is not None else None
     
     return n_action_frames, n_seg_frames
 
 
+class ValidationError(ValueError):
+    # raised by validate_prediction_dir with every problem found in the prediction
+    # directory. problems is a list of (location, message) tuples
+    def __init__(self, problems):
+        self.problems = problems
+        msg = f'prediction directory validation failed with {len(problems)} problem(s):\n'
+        msg += '\n'.join(f'{location}: {message}' for location, message in problems)
+        super().__init__(msg)
+
+
+def _list_names(names, max_names=10):
+    names = sorted(names)
+    return ', '.join(names[:max_names]) + (f' and {len(names)-max_names} more' if len(names) > max_names else '')
 
-def validate_prediction_dir(test_dir, prediction_dir, segmentation=True, actions=True):
-    ref_video_dirs = sorted([d for d in Path(test_dir).glob('video_*') if d.is_dir()])
-    pred_video_dirs = sorted([d for d in Path(prediction_dir).glob('video_*') if d.is_dir()])
 
-    if len(ref_video_dirs)==0 or len(pred_video_dirs)==0:
+def validate_prediction_dir(test_dir, prediction_dir, segmentation=True, actions=True, ref_cache=None):
+    # checks that prediction_dir follows the structure of test_dir. Every directory
+    # is listed once and every action file is parsed once. All problems are
+    # collected and reported together in a ValidationError.
+    test_dir, prediction_dir = Path(test_dir), Path(prediction_dir)
+    ref_videos = {n for n in scan_dir(test_dir)[1] if fnmatch(n, 'video_*')}
+    pred_videos = {n for n in scan_dir(prediction_dir)[1] if fnmatch(n, 'video_*')}
+
+    if len(ref_videos)==0 or len(pred_videos)==0:
         msg=f'{test_dir} or {prediction_dir} do not have child directories using the naming convention video_*'
         raise ValueError(msg)
 
-    if len(ref_video_dirs) != len(pred_video_dirs):
-        msg = f'prediction set and test set do not much in size {len(pred_video_dirs)}!={len(ref_video_dirs)}'
-        raise FileNotFoundError(msg)
-    
-
+    problems = []
+    for name in sorted(ref_videos - pred_videos):
+        problems.append((prediction_dir/name, f'video directory {name} of the test directory is missing'))
+    for name in sorted(pred_videos - ref_videos):
+        problems.append((prediction_dir/name, f'video directory {name} is not present in the test directory'))
 
-    for r_v, p_v in zip (ref_video_dirs, pred_video_dirs):
-        if r_v.name != p_v.name:
-            raise FileNotFoundError(f'video directory {p_v.name} is not present in the test directory or {r_v.name} is not present in the prediction directory')
-            
-    # validate action recognition prediciton files
-    
-    for r_v, p_v in zip (ref_video_dirs, pred_video_dirs):
+    for name in sorted(ref_videos & pred_videos):
+        r_v, p_v = test_dir/name, prediction_dir/name
+        ref_files, ref_dirs = scan_dir(r_v)
+        pred_files, pred_dirs = scan_dir(p_v)
         
         # find the length of the action labels based on the video file
-        len_ref_action, len_ref_seg = reference_sequence_len(r_v)
+        len_ref_action, len_ref_seg = reference_sequence_len(r_v, ref_cache, (ref_files, ref_dirs))
         
-        if segmentation:
-            if not (p_v/'segmentation').is_dir():
-                raise FileNotFoundError(f"{p_v/'segmentation'} is not a directory")
-            if len(list((p_v/'segmentation').iterdir())) != len_ref_seg:
-                l1 = [n.name for n in (p_v/'segmentation').iterdir()]
-                unique = [n.name for n in (r_v/'segmentation').iterdir() if n.name not in l1]
-                print(unique)
-                raise FileNotFoundError(f"segmentation file validation failed. {r_v} contained {len_ref_seg} files while {p_v} contained {len(list((p_v/'segmentation').iterdir()))}")
+        if segmentation and len_ref_seg is None:
+            problems.append((r_v, 'the number of reference segmentation frames could not be determined, '
+                                  'expected video_left.avi, rgb, action_discrete.txt, segmentation or a complete '
+                                  'segmentation_packed container(.npy and .txt)'))
+        elif segmentation:
+            pred_packed = load_packed(p_v/'segmentation') if 'segmentation_packed.npy' in pred_files else None
+            if 'segmentation' not in pred_dirs and pred_packed is None:
+                problems.append((p_v/'segmentation', 'is not a directory'))
+            else:
+                # predictions may be stored in any frame format or in a packed
+                # container, compare file stems
+                pred_names = pred_packed.names if pred_packed is not None else scan_dir(p_v/'segmentation')[0]
+                pred_seg = {Path(n).stem for n in pred_names}
+                if len(pred_seg) != len_ref_seg:
+                    msg = f'segmentation file validation failed. {r_v} contained {len_ref_seg} files while {p_v} contained {len(pred_seg)}'
+                    ref_packed = load_packed(r_v/'segmentation') if 'segmentation_packed.npy' in ref_files else None
+                    if ref_packed is not None or 'segmentation' in ref_dirs:
+                        ref_names = ref_packed.names if ref_packed is not None else scan_dir(r_v/'segmentation')[0]
+                        ref_seg = {Path(n).stem for n in ref_names}
+                        if ref_seg - pred_seg:
+                            msg += f'. missing: {_list_names(ref_seg - pred_seg)}'
+                        if pred_seg - ref_seg:
+                            msg += f'. not in reference: {_list_names(pred_seg - ref_seg)}'
+                    problems.append((p_v/'segmentation', msg))
 
         if actions:                
+            if 'action_discrete.txt' not in pred_files:
+                problems.append((p_v/'action_discrete.txt', 'does not exist'))
+                continue
             try:
-                with open(p_v/'action_discrete.txt') as ar:
-                    len_pred_action = len(ar.readlines())
-            except FileNotFoundError as e:
-                raise FileNotFoundError(f"{p_v/'action_discrete.txt'} does not exist")
-
-
-            if len_pred_action != len_ref_action:
-                raise FileNotFoundError(f"segmentation file validation failed. {(r_v/'action_discrete.txt')} contained {len_ref_action} lines while {(p_v/'action_discrete.txt')} contained {len_pred_action} lines")
+                pred_action = read_action_file(p_v/'action_discrete.txt')
+            except ValueError as e:
+                problems.append((p_v/'action_discrete.txt', str(e)))
+                continue
+
+            if len(pred_action) != len_ref_action:
+                problems.append((p_v/'action_discrete.txt', f"action file validation failed. {(r_v/'action_discrete.txt')} contained {len_ref_action} lines while {(p_v/'action_discrete.txt')} contained {len(pred_action)} lines"))
+                continue
             
             # do a last check to see if submitted predictions correspond to reference files
-            ref_action = np.genfromtxt(r_v/'action_discrete.txt', delimiter=',')
-            pred_action = np.genfromtxt(p_v/'action_discrete.txt', delimiter=',')
-            if not np.all(ref_action[:,0] == pred_action[:,0]):
-                raise ValueError(f"action file validation failed. {(p_v/'action_discrete.txt')} contained predictions that do not correspond to {(r_v/'action_discrete.txt')}")
-    return ref_video_dirs, pred_video_dirs
\ No newline at end of file
+            ref_action = read_ref_action_file(r_v/'action_discrete.txt', ref_cache)
+            if not np.array_equal(ref_action[:,0], pred_action[:,0]):
+                problems.append((p_v/'action_discrete.txt', f"action file validation failed. {(p_v/'action_discrete.txt')} contained predictions that do not correspond to {(r_v/'action_discrete.txt')}"))
+
+    if problems:
+        raise ValidationError(problems)
+    names = sorted(ref_videos)
+    return [test_dir/n for n in names], [prediction_dir/n for n in names]
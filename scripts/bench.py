@@ -0,0 +1,274 @@
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+from importlib import metadata
+from pathlib import Path
+import numpy as np
+
+
+# Synthetic benchmark of the evaluation hot paths. A reference and a prediction
+# tree are synthesized with the requested number of videos, frames, resolution and
+# action segment fragmentation, and every stage is timed separately. Results are
+# written as json so they can be compared between releases and backends.
+
+
+def mock_label_map(rng, height, width, n_blobs=6, n_classes=9):
+    # HxW label map with n_blobs random ellipses of random classes
+    import cv2# opencv is slow to import, rarptk bench --help does not need it
+    img = np.zeros((height, width), dtype=np.uint8)
+    for _ in range(n_blobs):
+        cv2.ellipse(img,
+                    (int(rng.integers(0, width)), int(rng.integers(0, height))),
+                    (int(rng.integers(5, max(width//4, 6))), int(rng.integers(5, max(height//4, 6)))),
+                    float(rng.integers(0, 180)), 0, 360, int(rng.integers(1, n_classes+1)), -1)
+    return img
+
+
+def mock_action_labels(rng, n_frames, segment_length, n_classes=8):
+    # labels made of segments with geometrically distributed lengths of mean segment_length
+    lengths = rng.geometric(1/max(segment_length, 1), size=n_frames//max(segment_length, 1)+1)
+    while lengths.sum() < n_frames:
+        lengths = np.concatenate([lengths, rng.geometric(1/max(segment_length, 1), size=len(lengths))])
+    return np.repeat(rng.integers(0, n_classes, size=len(lengths)), lengths)[:n_frames]
+
+
+def fragment(rng, labels, noise, n_classes=8, max_burst=5):
+    # copy of labels with short bursts of random labels covering about a noise
+    # fraction of the frames, which fragments the segments
+    labels = labels.copy()
+    n_bursts = int(noise*len(labels)/((max_burst+1)/2))
+    for start, length in zip(rng.integers(0, len(labels), size=n_bursts), rng.integers(1, max_burst+1, size=n_bursts)):
+        labels[start:start+length] = rng.integers(0, n_classes)
+    return labels
+
+
+def synthesize(root_dir, videos=2, frames=10, height=1080, width=1920, segment_length=300, noise=0.05, seed=0):
+    # writes ref/ and pred/ trees under root_dir. Every video has frames segmentation
+    # masks (1Hz) and (frames-1)*10+1 action labels (10Hz), like the SAR-RARP50 test set
+    import cv2
+    rng = np.random.default_rng(seed)
+    root_dir = Path(root_dir)
+    ref_root, pred_root = root_dir/'ref', root_dir/'pred'
+    for v in range(1, videos+1):
+        ref_dir, pred_dir = ref_root/f'video_{v:02d}', pred_root/f'video_{v:02d}'
+        (ref_dir/'segmentation').mkdir(parents=True)
+        (pred_dir/'segmentation').mkdir(parents=True)
+
+        n_action = (frames-1)*10+1
+        ids = np.arange(n_action)*6
+        ref_labels = mock_action_labels(rng, n_action, segment_length)
+        pred_labels = fragment(rng, ref_labels, noise)
+        for d, labels in ((ref_dir, ref_labels), (pred_dir, pred_labels)):
+            with open(d/'action_discrete.txt', 'w') as f:
+                f.write(''.join(f'{i:09d},{l}\n' for i, l in zip(ids, labels)))
+
+        for i in ids[::10]:
+            ref = mock_label_map(rng, height, width)
+            pred = ref.copy()
+            pred[mock_label_map(rng, height, width, n_blobs=2) > 0] = rng.integers(0, 10)
+            cv2.imwrite(str(ref_dir/'segmentation'/f'{i:09d}.png'), ref)
+            cv2.imwrite(str(pred_dir/'segmentation'/f'{i:09d}.png'), np.dstack([pred]*3))
+    return ref_root, pred_root
+
+
+def video_pairs(ref_root, pred_root):
+    return [(r, pred_root/r.name) for r in sorted(ref_root.glob('video_*'))]
+
+
+# every stage takes the reference and prediction roots and the metric backend
+# and returns the number of frames it processed. Stages that do not depend on
+# the backend are only run once.
+
+def bench_imread_one_hot(ref_root, pred_root, backend=None):
+    from sarrarp50.metrics.segmentation import imread_one_hot
+    n = 0
+    for ref_dir, _ in video_pairs(ref_root, pred_root):
+        for p in sorted((ref_dir/'segmentation').iterdir()):
+            imread_one_hot(p, 10)
+            n += 1
+    return n
+
+def bench_mIoU(ref_root, pred_root, backend='monai'):
+    from sarrarp50.metrics.segmentation import mIoU
+    return sum(len(mIoU(pred_dir, ref_dir, backend=backend)) for ref_dir, pred_dir in video_pairs(ref_root, pred_root))
+
+def bench_mNSD(ref_root, pred_root, backend='monai'):
+    from sarrarp50.metrics.segmentation import mNSD
+    return sum(len(mNSD(pred_dir, ref_dir, channel_tau=[10]*9, backend=backend)) for ref_dir, pred_dir in video_pairs(ref_root, pred_root))
+
+def bench_mIoU_mNSD(ref_root, pred_root, backend='monai'):
+    from sarrarp50.metrics.segmentation import mIoU_mNSD
+    return sum(len(mIoU_mNSD(pred_dir, ref_dir, channel_tau=[10]*9, backend=backend)[0]) for ref_dir, pred_dir in video_pairs(ref_root, pred_root))
+
+def bench_f1k(ref_root, pred_root, backend=None):
+    # times the segmental F1 computation only, action files are parsed up front
+    from sarrarp50.metrics.action_recognition import parse_action_file, _f1k
+    pairs = [(parse_action_file(p/'action_discrete.txt')[:,1], parse_action_file(r/'action_discrete.txt')[:,1])
+             for r, p in video_pairs(ref_root, pred_root)]
+    start = time.perf_counter()
+    for k in (10, 25, 50):
+        _f1k([p for p, _ in pairs], [y for _, y in pairs], n_classes=8, overlap=k/100)
+    return sum(len(y) for _, y in pairs), time.perf_counter()-start
+
+def bench_action_set(ref_root, pred_root, backend=None):
+    # times scoring the actions of all videos at once, action files are parsed up front
+    from sarrarp50.metrics.action_recognition import parse_action_file, score_action_set
+    pairs = [(parse_action_file(p/'action_discrete.txt')[:,1], parse_action_file(r/'action_discrete.txt')[:,1])
+             for r, p in video_pairs(ref_root, pred_root)]
+    start = time.perf_counter()
+    score_action_set([p for p, _ in pairs], [y for _, y in pairs], ks=(10, 25, 50), n_classes=8)
+    return sum(len(y) for _, y in pairs), time.perf_counter()-start
+
+def bench_validate(ref_root, pred_root, backend=None):
+    from sarrarp50.utils import validate_prediction_dir, _source_len
+    from sarrarp50.metrics.action_recognition import _read_action_file
+    # time a cold validation, as in a fresh evaluation process
+    _source_len.cache_clear()
+    _read_action_file.cache_clear()
+    validate_prediction_dir(ref_root, pred_root)
+    return len(video_pairs(ref_root, pred_root))
+
+
+# modules that must not be loaded by rarptk COMMAND --help
+HEAVY_MODULES = ('cv2', 'torch', 'monai', 'pandas', 'scipy')
+STARTUP_SCRIPT = '''
+import sys
+sys.argv = ['rarptk', {command!r}, '--help']
+import scripts.sarrarp50
+try:
+    scripts.sarrarp50.main()
+except SystemExit:
+    pass
+print(','.join(m for m in {heavy!r} if m in sys.modules), file=sys.stderr)
+'''
+
+def bench_startup(command, ref_root=None, pred_root=None, backend=None):
+    # wall time of rarptk COMMAND --help in a new python process, which is the
+    # latency every rarptk call pays before doing any work. Raises a RuntimeError
+    # if the command imports one of the HEAVY_MODULES just to parse its arguments.
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT.format(command=command, heavy=HEAVY_MODULES)],
+                          cwd=Path(__file__).resolve().parent.parent, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True, check=True)
+    elapsed = time.perf_counter()-start
+    loaded = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else ''
+    if loaded:
+        raise RuntimeError(f'rarptk {command} --help imports {loaded}')
+    return 1, elapsed
+
+
+# subdirectory of --work_dir holding the synthetic data, and the file marking it
+# as created by the bench
+BENCH_DIR = 'sarrarp50_bench'
+BENCH_MARKER = '.sarrarp50_bench'
+
+STAGES = {
+    'imread_one_hot': (bench_imread_one_hot, False),
+    'mIoU': (bench_mIoU, True),
+    'mNSD': (bench_mNSD, True),
+    'mIoU_mNSD': (bench_mIoU_mNSD, True),
+    'f1k': (bench_f1k, False),
+    'action_set': (bench_action_set, False),
+    'validate_prediction_dir': (bench_validate, False),
+}# stage name: (function, depends on the metric backend)
+for command in ('evaluate', 'unpack', 'generate', 'pack', 'bench'):
+    STAGES[f'startup_{command}'] = (partial(bench_startup, command), False)
+
+
+def time_stage(func, ref_root, pred_root, backend, repeat):
+    # runs func repeat times and returns the number of processed items and the wall
+    # times. Functions that time themselves return (items, seconds).
+    # func is called once untimed first, so one-off costs such as importing the
+    # metric backend are not included in the timings
+    func(ref_root, pred_root, backend)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = func(ref_root, pred_root, backend)
+        elapsed = time.perf_counter()-start
+        items, elapsed = res if isinstance(res, tuple) else (res, elapsed)
+        times.append(elapsed)
+    return items, times
+
+
+def _version(distribution):
+    # installed version of distribution, read from its metadata so it is not imported
+    try:
+        return metadata.version(distribution)
+    except metadata.PackageNotFoundError:
+        return None
+
+def environment():
+    cv2 = sys.modules.get('cv2')
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'numpy': np.__version__, 'opencv': cv2.__version__ if cv2 is not None else None,
+            'torch': _version('torch'), 'monai': _version('monai')}
+
+
+def run(args, root_dir):
+    ref_root, pred_root = synthesize(root_dir, args.videos, args.frames, args.height, args.width,
+                                     args.segment_length, args.noise, args.seed)
+    results = []
+    for stage in args.stages:
+        func, uses_backend = STAGES[stage]
+        for backend in (args.backends if uses_backend else [None]):
+            items, times = time_stage(func, ref_root, pred_root, backend, args.repeat)
+            results.append({'stage': stage, 'backend': backend, 'items': items,
+                            'times': times, 'min': min(times), 'mean': float(np.mean(times)),
+                            'per_item': min(times)/max(items, 1)})
+            print(f"{stage:<24}{backend or '':<8}{min(times):10.4f}s {min(times)/max(items, 1)*1000:10.3f}ms/item", file=sys.stderr)
+    return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='synthetic benchmark of the evaluation stages')
+    parser.add_argument('-o', '--output', help='json file to write the results to, printed to stdout if not set', default=None)
+    parser.add_argument('--videos', help='number of synthetic videos', type=int, default=2)
+    parser.add_argument('--frames', help='number of segmentation frames per video, every video has 10 times more action frames', type=int, default=10)
+    parser.add_argument('--height', help='height of the segmentation masks', type=int, default=1080)
+    parser.add_argument('--width', help='width of the segmentation masks', type=int, default=1920)
+    parser.add_argument('--segment_length', help='mean length of the reference action segments, in action frames', type=int, default=300)
+    parser.add_argument('--noise', help='fraction of the predicted action frames replaced by short bursts of random labels, higher values fragment the predicted segments', type=float, default=0.05)
+    parser.add_argument('--stages', help='stages to time', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--backends', help='segmentation metric backends to time', nargs='+', choices=['monai', 'numpy'], default=['monai', 'numpy'])
+    parser.add_argument('--repeat', help='number of times every stage is timed', type=int, default=3)
+    parser.add_argument('--seed', help='random seed of the synthetic data', type=int, default=0)
+    parser.add_argument('--work_dir', help='directory to synthesize the data under, in a new sarrarp50_bench subdirectory. A temporary directory is used and removed if not set', default=None)
+    return parser
+
+
+def main(args):
+    config = {k: v for k, v in vars(args).items() if k not in ('output', 'work_dir')}
+    if args.work_dir is not None:
+        # the data goes to a sarrarp50_bench subdirectory, marked as created by
+        # the bench so a later run only ever deletes the data of an earlier one
+        root_dir = Path(args.work_dir)/BENCH_DIR
+        if root_dir.exists():
+            if not (root_dir/BENCH_MARKER).is_file():
+                print(f'{root_dir} exists and was not created by the bench, remove it or pick another --work_dir', file=sys.stderr)
+                return 1
+            shutil.rmtree(root_dir)
+        root_dir.mkdir(parents=True)
+        (root_dir/BENCH_MARKER).touch()
+        results = run(args, root_dir)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results = run(args, tmp_dir)
+
+    report = json.dumps({'config': config, 'environment': environment(), 'results': results}, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report)
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    SystemExit(main(parser.parse_args()))
@@ -1,12 +1,21 @@
 import argparse
+import json
+import sys
+import time
 from pathlib import Path
 import logging
 import numpy as np
-import pandas as pd
 from sarrarp50.utils import TqdmLoggingHandler, validate_prediction_dir
-from sarrarp50.metrics.segmentation import mNSD, mIoU
-from sarrarp50.metrics.action_recognition import accuracy, f1k
+from sarrarp50.cache import ReferenceCache
+from sarrarp50.image_io import frame_paths
+from sarrarp50.packed import load_packed
+from sarrarp50.manifest import file_record, array_record, same_content, video_hash, load_manifest, save_manifest
+from sarrarp50.metrics.stats import ClassScoreAccumulator
+from sarrarp50 import profiling
+from sarrarp50.metrics.action_recognition import accuracy, f1k_curve, read_action_file, read_ref_action_file, score_action_set, confusion_stats
 from tqdm import tqdm 
+from functools import partial
+import concurrent.futures as cf
 
 
 
@@ -25,6 +34,15 @@ SEG_COLOR_DICT={
             }
 
 
+def f1_threshold(value):
+    # argparse type of --f1_thresholds. The segment matching of the F1@k scores
+    # is only defined for overlaps in the (0, 100] range
+    k = float(value)
+    if not 0 < k <= 100:
+        raise argparse.ArgumentTypeError(f'{value} is not in the 0 < k <= 100 range')
+    return k
+
+
 def get_parser():
     parser =argparse.ArgumentParser()
     parser.add_argument('ref_dir', help='path to directory containing video_xx directories with reference information')
@@ -32,23 +50,250 @@ def get_parser():
     parser.add_argument('--ignore_actions', help='do not evaluate action recognition', action='store_true')
     parser.add_argument('--ignore_segmentation', help='do not evaluate instrument segmentation',  action='store_true')
     parser.add_argument('--class_errors', help='save per-class scores for segmentation', action='store_true')
+    parser.add_argument('--backend', help='implementation used to compute the segmentation metrics', choices=['monai', 'numpy'], default='monai')
+    parser.add_argument('--ref_cache', help='directory to cache decoded reference files in, speeds up repeated evaluations against the same reference set', default=None)
+    parser.add_argument('--f1_thresholds', help='overlap thresholds(%%) to report action recognition F1@k scores for. F1@10 is always reported as it is used in the action score, 0 < k <= 100', nargs='+', type=f1_threshold, default=[10])
+    parser.add_argument('--streaming', help='aggregate per-frame segmentation scores into running statistics instead of keeping them in memory, for very long videos', action='store_true')
+    parser.add_argument('--decode_workers', help='number of threads decoding segmentation masks ahead of the metric computation of each video', default=0, type=int)
+    parser.add_argument('--batch_size', help='number of frames stacked into one tensor when computing monai metrics', default=1, type=int)
+    parser.add_argument('--approx_downscale', help='approximate segmentation scores on masks subsampled by this integer factor in each direction', default=1, type=int)
+    parser.add_argument('--approx_frame_step', help='approximate segmentation scores using only every n-th segmentation frame', default=1, type=int)
+    parser.add_argument('--calibrate', help='when approximating, also compute exact scores of the first N videos and report the deviation in approximation_report.csv', default=0, type=int)
+    parser.add_argument('--incremental', help='reuse the scores stored in the evaluation manifest of prediction_dir and only rescore files that changed since the last evaluation', action='store_true')
+    parser.add_argument('-j', '--jobs', help='number of videos to evaluate in parallel worker processes', default=1, type=int)
+    parser.add_argument('--profile', help=f'record the wall time, frames and bytes read of every evaluation stage and video in prediction_dir/{profiling.PROFILE_NAME}', action='store_true')
     return parser
 
-def main(args):
+
+def _init_worker(backend='monai'):
+    # every worker process evaluates a whole video on its own, limit torch to
+    # a single thread to avoid oversubscribing the cores. torch is only loaded
+    # for the monai backend
+    if backend == 'monai' or 'torch' in sys.modules:
+        import torch
+        torch.set_num_threads(1)
+
+
+def _profile_video(func, *args):
+    # runs func(*args) while recording the stages it goes through and returns its
+    # result together with the recorded stages. The stages are recorded in the
+    # process evaluating the video, so this also works in worker processes.
+    with profiling.StageRecorder() as recorder:
+        with profiling.stage('video'):
+            res = func(*args)
+    return res, recorder.stages
+
+
+def save_profile(prediction_dir, total, video_stages, seconds):
+    # writes the per-stage and per-video profile next to final_results.csv and
+    # returns its path
+    report = {'seconds': seconds,
+              'stages': profiling.with_throughput(total.stages),
+              'videos': {name: profiling.with_throughput(stages) for name, stages in video_stages.items()}}
+    path = Path(prediction_dir)/profiling.PROFILE_NAME
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return path
+
+
+def summarize_segmentation(iou_err, nsd_err, pred_dir, class_errors=False):
+    # computes the video mIoU and mNSD from the per-frame per-class scores and
+    # stores per-class statistics if class_errors is set. The scores are either
+    # arrays or sarrarp50.metrics.stats.ClassScoreAccumulator objects
+    results = {}
+    class_names = [SEG_COLOR_DICT[i]['label'] for i in range(1,10)]
+    for name, key, err in (('iou', 'seg_mIoU', iou_err), ('nsd', 'seg_mNSD', nsd_err)):
+        if isinstance(err, ClassScoreAccumulator):
+            stats_df = err.describe(columns=class_names) if class_errors else None
+            score = err.frame_mean()
+        else:
+            import pandas as pd
+            stats_df = pd.DataFrame(err, columns=class_names).describe() if class_errors else None
+            score = err.mean(axis=1).mean().item()
+        if class_errors:
+            stats_df.to_csv(pred_dir.parent/(pred_dir.name+f'_class_stats_{name}.csv'))
+        results[key] = score
+    return results
+
+
+def score_actions(ref_dir, pred_dir, ref_cache=None, f1_thresholds=(10,)):
+    results = {}
+    with profiling.stage('action_metrics'):
+        results['ar_acc'] = accuracy(pred_dir, ref_dir, ref_cache=ref_cache)
+        # F1 for all thresholds is computed from a single segment matching
+        f1_scores = f1k_curve(pred_dir, ref_dir, ks=f1_thresholds, n_classes=8, ref_cache=ref_cache)
+    for k, f1 in zip(f1_thresholds, f1_scores):
+        results[f'ar_f1@{k:g}'] = f1
+    return results
+
+
+def score_action_dirs(ref_video_dirs, pred_video_dirs, ref_cache=None, f1_thresholds=(10,)):
+    # scores the actions of all videos at once with score_action_set. returns the
+    # results of every video, with the keys of score_actions, and the
+    # (n_videos, 8, 8) frame confusion matrices of the videos
+    refs = [read_ref_action_file(d/'action_discrete.txt', ref_cache)[:,1] for d in ref_video_dirs]
+    preds = [read_action_file(d/'action_discrete.txt')[:,1] for d in pred_video_dirs]
+    with profiling.stage('action_metrics', frames=sum(len(r) for r in refs)):
+        scores = score_action_set(preds, refs, ks=f1_thresholds, n_classes=8)
+    results = []
+    for acc, f1_scores in zip(scores['accuracy'], scores['f1']):
+        res = {'ar_acc': acc}
+        for k, f1 in zip(f1_thresholds, f1_scores):
+            res[f'ar_f1@{k:g}'] = f1
+        results.append(res)
+    return results, scores['confusion']
 
 
+def save_action_class_errors(prediction_dir, video_ids, confusion):
+    # stores the frame confusion matrices of every video and of the whole set in
+    # action_confusion.csv and per-class statistics of the whole set in
+    # action_class_stats.csv
+    import pandas as pd
+    n_classes = confusion.shape[-1]
+    columns = [f'pred_{c}' for c in range(n_classes)]
+    tables = []
+    for video_id, cm in zip(list(video_ids)+['all'], list(confusion)+[confusion.sum(axis=0)]):
+        table = pd.DataFrame(cm, columns=columns)
+        table.insert(0, 'ref', range(n_classes))
+        table.insert(0, 'video_id', video_id)
+        tables.append(table)
+    pd.concat(tables).to_csv(Path(prediction_dir)/'action_confusion.csv', index=False)
+    stats_df = pd.DataFrame(confusion_stats(confusion.sum(axis=0)))
+    stats_df.index.name = 'class'
+    stats_df.to_csv(Path(prediction_dir)/'action_class_stats.csv')
+
+
+def evaluate_video(ref_dir, pred_dir, segmentation=True, actions=True, class_errors=False, NSD_tau=10, backend='monai', ref_cache=None, f1_thresholds=(10,), streaming=False, decode_workers=0, batch_size=1, downscale=1, frame_step=1):
+    # computes the scores of a single video. Scores of one video do not depend on
+    # any other video, so this can run in a separate worker process. 
+    results = {}
+    if segmentation:
+        # the segmentation metrics import torch and monai, only load them when needed
+        from sarrarp50.metrics.segmentation import mIoU_mNSD
+        # IoU and NSD are computed together so every mask is only decoded once
+        iou_err, nsd_err = mIoU_mNSD(pred_dir, ref_dir, n_classes=9, channel_tau=[NSD_tau]*9,
+                                     backend=backend, ref_cache=ref_cache, accumulate=streaming,
+                                     decode_workers=decode_workers, batch_size=batch_size,
+                                     downscale=downscale, frame_step=frame_step)
+        results.update(summarize_segmentation(iou_err, nsd_err, pred_dir, class_errors))
+    if actions:
+        results.update(score_actions(ref_dir, pred_dir, ref_cache, f1_thresholds))
+    return results
+
+
+def evaluate_video_incremental(ref_dir, pred_dir, manifest_entry, action_scores=None, segmentation=True, actions=True, class_errors=False, NSD_tau=10, backend='monai', ref_cache=None, f1_thresholds=(10,), streaming=False, decode_workers=0, batch_size=1, downscale=1, frame_step=1):
+    # same as evaluate_video, but reuses the scores stored in the manifest entry of
+    # the video for every file whose content did not change. Only changed
+    # segmentation frames are decoded and scored. action_scores are the action
+    # results of the video if they were already scored, see score_action_dirs.
+    # returns the video results, the updated manifest entry and the number of
+    # segmentation frames that were scored
+    results = {}
+    entry = {}
+    n_scored = 0
+    if segmentation:
+        ref_seg_dir, pred_seg_dir = ref_dir/'segmentation', pred_dir/'segmentation'
+        # masks stored in packed containers are hashed from the memory mapped arrays
+        ref_packed, pred_packed = load_packed(ref_seg_dir), load_packed(pred_seg_dir)
+        if ref_packed is not None:
+            names = sorted(ref_packed.names)[::frame_step]
+        else:
+            names = [p.name for p in sorted(ref_seg_dir.iterdir())][::frame_step]
+        pred_paths = frame_paths(pred_seg_dir) if pred_packed is None else None# predictions are matched by stem
+        previous = manifest_entry.get('frames', {})
+        frames, changed = {}, []
+        # content hashes of the frames, only changed files are read
+        with profiling.stage('hash', frames=len(names)):
+            for name in names:
+                prev = previous.get(name, {})
+                if ref_packed is not None:
+                    ref_record = array_record(ref_packed.get(name), ref_packed.mtime_ns, prev.get('ref'))
+                else:
+                    ref_record = file_record(ref_seg_dir/name, prev.get('ref'))
+                if pred_packed is not None:
+                    pred_record = array_record(pred_packed.get(name), pred_packed.mtime_ns, prev.get('pred'))
+                else:
+                    pred_p = pred_paths.get(Path(name).stem)
+                    pred_record = file_record(pred_p, prev.get('pred')) if pred_p is not None else None
+                record = {'ref': ref_record, 'pred': pred_record}
+                if prev and same_content(record['ref'], prev['ref']) and same_content(record['pred'], prev['pred']):
+                    record['iou'], record['nsd'] = prev['iou'], prev['nsd']
+                else:
+                    changed.append(name)
+                frames[name] = record
+
+        if changed:
+            from sarrarp50.metrics.segmentation import mIoU_mNSD
+            iou_err, nsd_err = mIoU_mNSD(pred_dir, ref_dir, n_classes=9, channel_tau=[NSD_tau]*9,
+                                         backend=backend, ref_cache=ref_cache,
+                                         decode_workers=decode_workers, batch_size=batch_size,
+                                         downscale=downscale, frames=changed)
+            # scores are returned in sorted frame order, same as changed
+            for name, iou, nsd in zip(changed, iou_err.tolist(), nsd_err.tolist()):
+                frames[name]['iou'], frames[name]['nsd'] = iou, nsd
+        n_scored = len(changed)
+        entry['frames'] = frames
+        entry['segmentation_hash'] = video_hash(frames)
+
+        iou_err = np.array([frames[name]['iou'] for name in names])
+        nsd_err = np.array([frames[name]['nsd'] for name in names])
+        if streaming:
+            iou_acc, nsd_acc = ClassScoreAccumulator(9), ClassScoreAccumulator(9)
+            for iou, nsd in zip(iou_err, nsd_err):
+                iou_acc.append(iou)
+                nsd_acc.append(nsd)
+            iou_err, nsd_err = iou_acc, nsd_acc
+        results.update(summarize_segmentation(iou_err, nsd_err, pred_dir, class_errors))
+
+    if actions:
+        prev = manifest_entry.get('actions', {})
+        record = {'ref': file_record(ref_dir/'action_discrete.txt', prev.get('ref')),
+                  'pred': file_record(pred_dir/'action_discrete.txt', prev.get('pred'))}
+        action_keys = ['ar_acc'] + [f'ar_f1@{k:g}' for k in f1_thresholds]
+        if action_scores is not None:
+            record['scores'] = action_scores
+        elif (prev and same_content(record['ref'], prev['ref']) and same_content(record['pred'], prev['pred'])
+                and all(key in prev['scores'] for key in action_keys)):
+            record['scores'] = prev['scores']
+        else:
+            record['scores'] = score_actions(ref_dir, pred_dir, ref_cache, f1_thresholds)
+        entry['actions'] = record
+        results.update({key: record['scores'][key] for key in action_keys})
+    return results, entry, n_scored
+
+def main(args):
+    import pandas as pd
+
     logging.basicConfig(encoding='utf-8', level=logging.INFO,
                         handlers=[logging.FileHandler(Path(args.prediction_dir)/"evaluation.log"),
                         TqdmLoggingHandler()])
+    ref_cache = ReferenceCache(args.ref_cache) if args.ref_cache is not None else None
+    if args.profile:
+        # stages of the main process, the stages of every video are recorded by _profile_video
+        start = time.perf_counter()
+        profile, video_stages = profiling.StageRecorder(), {}
+        profiling.add_hook(profile)
+    f1_thresholds = sorted(set(args.f1_thresholds) | {10}) if not args.ignore_actions else [10]
+    # the actions of all videos are scored at once in the main process, the
+    # incremental evaluation reuses the action scores of its manifest instead,
+    # unless the confusion matrices of all videos are needed anyway
+    score_all_actions = not args.ignore_actions and (not args.incremental or args.class_errors)
     try:
-        ref_video_dirs, pred_video_dirs = validate_prediction_dir(args.ref_dir, 
-                                                                  args.prediction_dir,
-                                                                  not args.ignore_segmentation,
-                                                                  not args.ignore_actions)
+        with profiling.stage('validate'):
+            ref_video_dirs, pred_video_dirs = validate_prediction_dir(args.ref_dir, 
+                                                                      args.prediction_dir,
+                                                                      not args.ignore_segmentation,
+                                                                      not args.ignore_actions,
+                                                                      ref_cache=ref_cache)
         logging.info('file structure validation passed')
+        if score_all_actions:
+            action_results, action_confusion = score_action_dirs(ref_video_dirs, pred_video_dirs, ref_cache, f1_thresholds)
     except (FileNotFoundError, ValueError)as f_e:
         logging.error(f_e)
         return 1
+    finally:
+        if args.profile:
+            profiling.remove_hook(profile)
     
     NSD_tau=10
  
@@ -58,30 +303,89 @@ def main(args):
         results['seg_mNSD']=[]
     if not args.ignore_actions:
         results['ar_acc']=[]
-        results['ar_f1@10']=[]
-    for ref_dir, pred_dir in tqdm(zip(ref_video_dirs, pred_video_dirs),
-                                  desc='evalute videos',
-                                  bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}',
-                                  total = len(ref_video_dirs)):
-        if not args.ignore_segmentation:
-            dataset_err = np.array(mIoU(pred_dir, ref_dir, n_classes=9))
-            if args.class_errors:
-                dataset_df = pd.DataFrame(dataset_err, columns= [SEG_COLOR_DICT[i]['label'] for i in range(1,10)])
-                dataset_df.describe().to_csv(pred_dir.parent/(pred_dir.name+'_class_stats_iou.csv'))
-            results['seg_mIoU'].append(dataset_err.mean(axis=1).mean().item())
-            logging.info(f"{ref_dir.name} segmentaiton mIoU: {results['seg_mIoU'][-1]}")
-            
-            dataset_err = np.array(mNSD(pred_dir, ref_dir,n_classes=9, channel_tau=[NSD_tau]*9))
-            if args.class_errors:
-                dataset_df = pd.DataFrame(dataset_err, columns= [SEG_COLOR_DICT[i]['label'] for i in range(1,10)])
-                dataset_df.describe().to_csv(pred_dir.parent/(pred_dir.name+'_class_stats_nsd.csv'))
-            results['seg_mNSD'].append(dataset_err.mean(axis=1).mean().item())
-            logging.info(f"{ref_dir.name} segmentation mNSD: {results['seg_mNSD'][-1]}")
-        if not args.ignore_actions:
-            results['ar_acc'].append(accuracy(pred_dir, ref_dir))
-            logging.info(f"{ref_dir.name} action recognition accuracy : {results['ar_acc'][-1]}")
-            results['ar_f1@10'].append(f1k(pred_dir, ref_dir, k=10, n_classes=8))
-            logging.info(f"{ref_dir.name} action recognition F1@10 : {results['ar_f1@10'][-1]}")
+        for k in f1_thresholds:
+            results[f'ar_f1@{k:g}']=[]
+    video_kwargs = dict(segmentation=not args.ignore_segmentation, actions=not args.ignore_actions and args.incremental,
+                        class_errors=args.class_errors, NSD_tau=NSD_tau, backend=args.backend,
+                        ref_cache=ref_cache, f1_thresholds=f1_thresholds, streaming=args.streaming,
+                        decode_workers=args.decode_workers, batch_size=args.batch_size,
+                        downscale=args.approx_downscale, frame_step=args.approx_frame_step)
+    approximate = args.approx_downscale > 1 or args.approx_frame_step > 1
+    if approximate and not args.ignore_segmentation:
+        logging.info(f'segmentation scores are approximated with downscale={args.approx_downscale}, frame_step={args.approx_frame_step}')
+    executor = None
+    if args.jobs > 1:
+        # videos are scored in worker processes, map() yields the results in
+        # submission order so the output is identical to the serial run
+        executor = cf.ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker, initargs=(args.backend,))
+        video_map = executor.map
+    else:
+        video_map = map
+    try:
+        if args.incremental:
+            # the manifest is only valid for the settings that affect the scores
+            manifest_settings = {'NSD_tau': NSD_tau, 'downscale': args.approx_downscale, 'frame_step': args.approx_frame_step}
+            manifest = load_manifest(args.prediction_dir, manifest_settings)
+            # yields (results, manifest entry, number of scored frames) for every video
+            video_func = partial(evaluate_video_incremental, **video_kwargs)
+            video_args = (ref_video_dirs, pred_video_dirs, [manifest.get(d.name, {}) for d in ref_video_dirs],
+                          action_results if score_all_actions else [None]*len(ref_video_dirs))
+            n_scored = 0
+        else:
+            video_func = partial(evaluate_video, **video_kwargs)
+            video_args = (ref_video_dirs, pred_video_dirs)
+        if args.profile:
+            # yields (video results, recorded stages) instead
+            video_func = partial(_profile_video, video_func)
+        video_results = video_map(video_func, *video_args)
+
+        for i, (ref_dir, video_res) in enumerate(tqdm(zip(ref_video_dirs, video_results),
+                                      desc='evalute videos',
+                                      bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}',
+                                      total = len(ref_video_dirs))):
+            if args.profile:
+                video_res, video_stages[ref_dir.name] = video_res
+                profile.merge(video_stages[ref_dir.name])
+            if args.incremental:
+                video_res, manifest[ref_dir.name], n = video_res
+                n_scored += n
+            elif score_all_actions:
+                video_res.update(action_results[i])
+            if not args.ignore_segmentation:
+                results['seg_mIoU'].append(video_res['seg_mIoU'])
+                logging.info(f"{ref_dir.name} segmentaiton mIoU: {results['seg_mIoU'][-1]}")
+                results['seg_mNSD'].append(video_res['seg_mNSD'])
+                logging.info(f"{ref_dir.name} segmentation mNSD: {results['seg_mNSD'][-1]}")
+            if not args.ignore_actions:
+                results['ar_acc'].append(video_res['ar_acc'])
+                logging.info(f"{ref_dir.name} action recognition accuracy : {results['ar_acc'][-1]}")
+                for k in f1_thresholds:
+                    results[f'ar_f1@{k:g}'].append(video_res[f'ar_f1@{k:g}'])
+                    logging.info(f"{ref_dir.name} action recognition F1@{k:g} : {results[f'ar_f1@{k:g}'][-1]}")
+        if args.incremental:
+            save_manifest(args.prediction_dir, manifest_settings, manifest)
+            logging.info(f'incremental evaluation rescored {n_scored} segmentation frames')
+
+        if approximate and args.calibrate > 0 and not args.ignore_segmentation:
+            # score the calibration videos exactly and report the approximation error
+            n_calib = min(args.calibrate, len(ref_video_dirs))
+            exact_kwargs = dict(video_kwargs, actions=False, class_errors=False, downscale=1, frame_step=1)
+            exact_results = video_map(partial(evaluate_video, **exact_kwargs), ref_video_dirs[:n_calib], pred_video_dirs[:n_calib])
+            exact_results = list(exact_results)
+            calib = {'video_id': results['video_id'][:n_calib]}
+            for key in ('seg_mIoU', 'seg_mNSD'):
+                calib[key+'_exact'] = np.array([exact_res[key] for exact_res in exact_results])
+                calib[key+'_approx'] = np.array(results[key][:n_calib])
+                calib[key+'_abs_error'] = np.abs(calib[key+'_approx'] - calib[key+'_exact'])
+            calib_df = pd.DataFrame(calib)
+            calib_df.to_csv(Path(args.prediction_dir)/'approximation_report.csv', index=False)
+            logging.info(f"approximation error on {n_calib} calibration videos: "
+                         f"mIoU mean {calib_df['seg_mIoU_abs_error'].mean()} max {calib_df['seg_mIoU_abs_error'].max()}, "
+                         f"mNSD mean {calib_df['seg_mNSD_abs_error'].mean()} max {calib_df['seg_mNSD_abs_error'].max()}")
+    finally:
+        # also runs if a video fails, the videos that did not start are cancelled
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
             
     df = pd.DataFrame(results)
@@ -93,12 +397,18 @@ def main(args):
         m_df['action_score']= (df['ar_acc'].mean() * df['ar_f1@10'].mean())**(0.5)
             
     # dump files in the prediction folders
+    if args.class_errors and not args.ignore_actions:
+        save_action_class_errors(args.prediction_dir, results['video_id'], action_confusion)
     df.to_csv(Path(args.prediction_dir)/'per_video_results.csv', index=False)
     m_df.to_csv(Path(args.prediction_dir)/'final_results.csv')
     logging.info("per video results")
     logging.info(df)
     logging.info("final results")
     logging.info(m_df)
+    if args.profile:
+        seconds = time.perf_counter() - start
+        path = save_profile(args.prediction_dir, profile, video_stages, seconds)
+        logging.info(f'profile: {seconds:.3f}s total, {profiling.summary(profile.stages)}. details in {path}')
 
 if __name__ == "__main__":
     parser = get_parser()
@@ -3,16 +3,20 @@ from pathlib import Path
 import logging
 import shutil
 import numpy as np
-import csv
-import cv2
+import concurrent.futures as cf
+from collections import deque
+from functools import lru_cache
 from sarrarp50.utils import TqdmLoggingHandler
+from sarrarp50.image_io import FRAME_FORMATS, frame_path, encode_frame
 from tqdm import tqdm
 
 
 
-def mock_seg_img(msg, height, width):
+def mock_seg_img(msg, height, width, color=None):
+    import cv2# opencv is slow to import, rarptk generate --help does not need it
     img = np.zeros((height,width,3), dtype=np.uint8)
-    color = np.random.randint(0,10)#*10
+    if color is None:
+        color = np.random.randint(0,10)#*10
     cv2.putText(img,
                 f"{msg}", 
                 (50,int(height/2)),# bottom left corner 
@@ -24,7 +28,26 @@ def mock_seg_img(msg, height, width):
     return img
 
 
+@lru_cache(maxsize=4096)
+def cached_mock_seg_img(msg, height, width, color, fmt, png_compression):
+    # encoded mock mask. Masks only depend on the frame name and the color, and
+    # every video of a test set uses the same frame names, so the cached bytes are
+    # reused across videos and across generated prediction sets.
+    return encode_frame(mock_seg_img(msg, height, width, color), fmt, png_compression)
+
+
+def write_mock_seg_img(filepath, msg, height, width, color, fmt, png_compression, cache=False):
+    if cache:
+        data = cached_mock_seg_img(msg, height, width, color, fmt, png_compression)
+    else:
+        data = encode_frame(mock_seg_img(msg, height, width, color), fmt, png_compression)
+    with open(frame_path(filepath, fmt), 'wb') as f:
+        f.write(data)
+
+
 def main(args):
+    if args.seed is not None:
+        np.random.seed(args.seed)
     test_root_dir = Path(args.test_dir)
     test_video_dirs = [n for n in test_root_dir.iterdir() if n.is_dir()]
     dst_root_dir = Path(args.prediction_dir)
@@ -52,26 +75,45 @@ def main(args):
     for video_dir in tqdm(test_video_dirs, desc='generate mock action predicitons', bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
         rgb_ids = sorted([img_p.stem for img_p in (video_dir/'rgb').iterdir()])
         mock_action_labels = np.random.randint(8, size=len(rgb_ids))
-        with open(dst_root_dir/video_dir.name/'action_discrete.txt', 'w') as f:
-            csv_writer = csv.writer(f)
-            for img_id, label in zip (rgb_ids, mock_action_labels):
-                csv_writer.writerow([img_id, label])
+        # written in one call, with the same \r\n line endings as csv.writer
+        with open(dst_root_dir/video_dir.name/'action_discrete.txt', 'w', newline='') as f:
+            f.write(''.join(f'{img_id},{label}\r\n' for img_id, label in zip(rgb_ids, mock_action_labels)))
             logging.info(f" generate mock action recognition predicitons for {video_dir.name}, at {dst_root_dir/video_dir.name/'action_discrete.txt'}")
 
     # create mock 3 channel 1920x1080 segmentation images
-
-    for video_dir in tqdm(test_video_dirs, desc='generate mock segmentation predictions', bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
-        rgb_names = sorted([img_p.name for img_p in (video_dir/'rgb').iterdir()])[::10]# processing one every 10 rgb images(10Hz) is equivilant to processing the video at 1Hz
-        for name in tqdm(rgb_names, desc=f'segmentation files for {video_dir.name}', leave=False, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
-            cv2.imwrite(str(dst_root_dir/video_dir.name/'segmentation'/name), 
-                        mock_seg_img(name, 1080, 1920))
-        logging.info(f"generate mock segmentation predicitons for {video_dir.name}, under {dst_root_dir/video_dir.name/'segmentation'}")
+    # masks are rendered, encoded and written by a pool of args.jobs threads, at
+    # most 4*args.jobs masks are queued at any time
+    with cf.ThreadPoolExecutor(max_workers=args.jobs) as writer:
+        pending = deque()
+        for video_dir in tqdm(test_video_dirs, desc='generate mock segmentation predictions', bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
+            rgb_ids = sorted([img_p.stem for img_p in (video_dir/'rgb').iterdir()])[::10]# processing one every 10 rgb images(10Hz) is equivilant to processing the video at 1Hz
+            # colors are drawn in frame order, so a seed gives the same masks for any number of jobs
+            colors = np.random.randint(0,10, size=len(rgb_ids))
+            for img_id, color in tqdm(zip(rgb_ids, colors), total=len(rgb_ids), desc=f'segmentation files for {video_dir.name}', leave=False, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
+                pending.append(writer.submit(write_mock_seg_img, dst_root_dir/video_dir.name/'segmentation'/img_id,
+                                             img_id+FRAME_FORMATS[args.format], 1080, 1920, int(color),
+                                             args.format, args.png_compression, args.fast))
+                if len(pending) >= 4*args.jobs:
+                    pending.popleft().result()
+            while pending:
+                pending.popleft().result()
+            logging.info(f"generate mock segmentation predicitons for {video_dir.name}, under {dst_root_dir/video_dir.name/'segmentation'}")
 
 
-if __name__ == "__main__":
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('test_dir', help='root_directory of the test set')
     parser.add_argument('prediction_dir', help='directory to store predictions')
     parser.add_argument('-o','--overwrite', help='overwrite the predictions of prediction_dir', action='store_true')
+    parser.add_argument('--format', help='format of the segmentation masks, webp is lossless', choices=list(FRAME_FORMATS), default='png')
+    parser.add_argument('--png_compression', help='png compression level, from 0(fastest, largest) to 9(slowest, smallest). opencv\'s default if not set', choices=range(10), type=int, default=None)
+    parser.add_argument('-j', '--jobs', help='number of parallel works to use when writing masks', default=4, type=int)
+    parser.add_argument('--fast', help='reuse encoded masks across videos instead of rendering and encoding every mask. the generated files are the same', action='store_true')
+    parser.add_argument('--seed', help='random seed, the same seed generates the same predictions', type=int, default=None)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = get_parser()
     
     SystemExit(main(parser.parse_args()))
\ No newline at end of file
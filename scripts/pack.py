@@ -0,0 +1,54 @@
+import argparse
+import warnings
+import concurrent.futures as cf
+from pathlib import Path
+from tqdm import tqdm
+from sarrarp50.image_io import frame_paths
+from sarrarp50.packed import load_packed, pack_frames, file_stats
+from sarrarp50.metrics.segmentation import imread_label
+
+
+def pack_segmentation(seg_dir:Path, jobs:int=4):
+    # packs every mask under seg_dir into the container of seg_dir, see sarrarp50.packed.
+    # Masks are decoded by jobs threads, in order.
+    # the sizes and modification times of the masks are taken before they are read,
+    # so masks rewritten while packing invalidate the container
+    stats = file_stats(seg_dir)
+    paths = sorted(frame_paths(seg_dir).values())
+    if not paths:
+        raise ValueError(f'{seg_dir} does not contain any segmentation masks')
+    first = imread_label(paths[0])
+    shape = (len(paths), *first.shape)
+    with cf.ThreadPoolExecutor(max_workers=jobs) as pool:
+        labels = pool.map(imread_label, paths)
+        frames = ((p.name, label) for p, label in zip(tqdm(paths, desc=f'packing {seg_dir.parent.name}', leave=False, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'), labels))
+        return pack_frames(seg_dir, frames, shape, stats)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_dir', help='path pointing to a video, dataset or prediction directory. every segmentation directory under it is packed')
+    parser.add_argument('-j', '--jobs', help='number of threads to use when decoding masks', default=4, type=int)
+    parser.add_argument('-f', '--force', help='pack directories that already have an up to date container again', action='store_true')
+    return parser
+
+
+def main(args):
+    data_dir = Path(args.data_dir)
+    seg_dirs = sorted(p for p in data_dir.rglob('segmentation') if p.is_dir())
+    if data_dir.name == 'segmentation':
+        seg_dirs.insert(0, data_dir)
+    if not seg_dirs:
+        print(f'{data_dir} does not contain any segmentation directories')
+        return 1
+    for seg_dir in tqdm(seg_dirs, desc='packing segmentation masks', bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')# outdated containers are packed again below
+            if not args.force and load_packed(seg_dir) is not None:
+                continue
+        pack_segmentation(seg_dir, args.jobs)
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    SystemExit(main(parser.parse_args()))
@@ -1,24 +1,117 @@
-import cv2
+import hashlib
+import warnings
 from pathlib import Path
-from tqdm import tqdm 
+from tqdm import tqdm
 import concurrent.futures as cf
+from collections import deque
 import argparse
+from sarrarp50.image_io import FRAME_FORMATS, write_frame, read_frame, frame_paths
 
-def sample_video(video_path:Path, extract_dir:Path, sampling_period:int=6, jobs:int=1):
+def _extract_frames(vid, extract_dir, start, stop, sampling_period, jobs=1, max_queued=None, progress=True, fmt='png', png_compression=None):
+    # writes every sampling_period-th frame in [start, stop) of vid under extract_dir
+    # in format fmt, see sarrarp50.image_io.write_frame. vid must be positioned at frame start. Skipped frames are only
+    # grabbed, never decoded to an image. Frames are written by a pool of jobs
+    # threads, at most max_queued (4*jobs by default) frames are waiting to be
+    # written at any time, which bounds memory use.
+    # Returns the index of the next frame of vid.
+    max_queued = max(max_queued or 4*jobs, 1)
+    next_idx = stop
+    with cf.ThreadPoolExecutor(max_workers=jobs) as parallel_saver:
+        pending = deque()
+        for frame_idx in tqdm(range(start, stop), desc='sampling video', leave=False, disable=not progress, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
+            if not vid.grab():
+                # the video is shorter than CAP_PROP_FRAME_COUNT reported
+                next_idx = frame_idx
+                break
+            if frame_idx%sampling_period!=0:
+                continue
+            _, frame = vid.retrieve()
+            pending.append(parallel_saver.submit(write_frame,
+                                                 extract_dir/f'{frame_idx:09d}',
+                                                 frame, fmt, png_compression))
+            if len(pending) >= max_queued:
+                # wait for the oldest write, this also raises its exceptions
+                pending.popleft().result()
+        # the queued writes are always waited for, so their exceptions are raised
+        while pending:
+            pending.popleft().result()
+    return next_idx
+
+def sample_video(video_path:Path, extract_dir:Path, sampling_period:int=6, jobs:int=1, max_queued:int=None, progress:bool=True, fmt:str='png', png_compression:int=None):
+    # extracts every sampling_period-th frame of video_path under extract_dir
+    import cv2# opencv is slow to import, rarptk unpack --help does not need it
     vid = cv2.VideoCapture(str(video_path))
     extract_dir.mkdir(exist_ok=True)
     n_frames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
-    parallel_saver = cf.ThreadPoolExecutor(max_workers=jobs)
-
-    for frame_idx in tqdm(range(n_frames), desc='sampling video', leave=False, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
-        _, frame = vid.read()
-        # print(frame_idx//period, frame_idx%period)
-        if frame_idx%sampling_period==0:
-            parallel_saver.submit(cv2.imwrite, 
-                                  str(extract_dir/f'{frame_idx:09d}.png'),
-                                  frame)
+    _extract_frames(vid, extract_dir, 0, n_frames, sampling_period, jobs, max_queued, progress, fmt, png_compression)
     vid.release()
 
+def _frame_hash(frame):
+    return None if frame is None else hashlib.sha1(frame.tobytes()).hexdigest()
+
+def _sample_chunk(video_path, extract_dir, start, stop, sampling_period, jobs, seek=True, fmt='png', png_compression=None):
+    # extracts the sampled frames in [start, stop) of video_path. With seek set the
+    # video is opened at frame start (opencv decodes forward from the preceding
+    # keyframe), otherwise every frame before start is grabbed.
+    # Returns the hash of frame stop decoded sequentially after the chunk, which is
+    # compared to the first frame written by the next chunk to verify its seek.
+    import cv2
+    vid = cv2.VideoCapture(str(video_path))
+    if seek and start > 0:
+        vid.set(cv2.CAP_PROP_POS_FRAMES, start)
+    else:
+        for _ in range(start):
+            vid.grab()
+    next_idx = _extract_frames(vid, extract_dir, start, stop, sampling_period, jobs, progress=False, fmt=fmt, png_compression=png_compression)
+    stop_hash = None
+    if next_idx == stop and vid.grab():
+        stop_hash = _frame_hash(vid.retrieve()[1])
+    vid.release()
+    return stop_hash
+
+def sample_video_chunked(video_path:Path, extract_dir:Path, sampling_period:int=6, jobs:int=1, chunks:int=4, fmt:str='png', png_compression:int=None):
+    # same output as sample_video, but the frame range of the video is split into
+    # chunks that are decoded by parallel processes, each seeking to the start of
+    # its chunk. Chunks start at sampled frames. 
+    # Seeking is not frame accurate for every codec, so the first frame written by
+    # every chunk is compared with the same frame decoded sequentially by the
+    # previous chunk. Chunks that do not match are extracted again without seeking.
+    import cv2
+    vid = cv2.VideoCapture(str(video_path))
+    extract_dir.mkdir(exist_ok=True)
+    n_frames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+    vid.release()
+    sampled = range(0, n_frames, sampling_period)
+    chunks = max(min(chunks, len(sampled)), 1)
+    bounds = [sampled[i*len(sampled)//chunks] for i in range(chunks)] + [n_frames]
+
+    with cf.ProcessPoolExecutor(max_workers=chunks) as executor:
+        futures = [executor.submit(_sample_chunk, video_path, extract_dir, start, stop, sampling_period, jobs, True, fmt, png_compression)
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+        stop_hashes = [f.result() for f in tqdm(futures, desc='sampling video', leave=False, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')]
+
+    # verify the chunks in order, a chunk extracted again also replaces the
+    # hash its successor is compared to
+    written = frame_paths(extract_dir)
+    for k in range(1, chunks):
+        first_p = written.get(f'{bounds[k]:09d}')
+        first_frame = read_frame(first_p) if first_p is not None else None
+        if _frame_hash(first_frame) != stop_hashes[k-1]:
+            warnings.warn(f'seeking to frame {bounds[k]} of {video_path} was not frame accurate, extracting frames {bounds[k]}-{bounds[k+1]-1} sequentially')
+            stop_hashes[k] = _sample_chunk(video_path, extract_dir, bounds[k], bounds[k+1], sampling_period, jobs, False, fmt, png_compression)
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_dir', help='path pointing to the video or dataset directory')
+    parser.add_argument('-f', '--frequency', type=int, help='sampling rate in Hz', choices= [1, 10], default=10)
+    parser.add_argument('-r', '--recursive', help='search recursively for video directories that have video_left.avi as a child', action='store_true')
+    parser.add_argument('-j', '--jobs', help='number of parallel works to use when saving images', default=4, type=int)
+    parser.add_argument('-p', '--processes', help='number of videos to unpack in parallel processes when --recursive is set', default=1, type=int)
+    parser.add_argument('--format', help='format of the extracted frames, webp is lossless', choices=list(FRAME_FORMATS), default='png')
+    parser.add_argument('--png_compression', help='png compression level, from 0(fastest, largest) to 9(slowest, smallest). opencv\'s default if not set', choices=range(10), type=int, default=None)
+    parser.add_argument('-c', '--chunks', help='split every video in CHUNKS frame ranges that are unpacked in parallel processes, seeking to the start of each range', default=1, type=int)
+    return parser
+
 def main(args):
 
     video_fps = 60 # all the sarrarp50 videos are recorded at 60 fps
@@ -33,20 +126,31 @@ def main(args):
     for directory in video_dirs:
         if not (directory.exists() and (directory/'video_left.avi').exists()):
             print(f"{directory} does not a video directory. please make sure video directory path is correct")
-    
+
+    if args.chunks > 1:
+        # videos are unpacked one after the other, every video uses all the chunk processes
+        for directory in tqdm(video_dirs, desc='unpacking dataset', bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
+            sample_video_chunked(directory/'video_left.avi', directory/'rgb', sampiling_period, args.jobs, args.chunks, args.format, args.png_compression)
+        return
+
+    if args.processes > 1 and len(video_dirs) > 1:
+        # every process unpacks one video at a time with its own writer threads.
+        # per-video progress bars are disabled because they would overlap
+        with cf.ProcessPoolExecutor(max_workers=args.processes) as executor:
+            futures = [executor.submit(sample_video, directory/'video_left.avi', directory/'rgb', sampiling_period, args.jobs, None, False, args.format, args.png_compression)
+                       for directory in video_dirs]
+            for future in tqdm(cf.as_completed(futures), total=len(futures), desc='unpacking dataset', bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
+                future.result()
+        return
+
     for directory in tqdm(video_dirs, desc='unpacking dataset', bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
         rgb_dir = (directory/'rgb')
-        sample_video(directory/'video_left.avi', rgb_dir, sampiling_period, args.jobs)
+        sample_video(directory/'video_left.avi', rgb_dir, sampiling_period, args.jobs, fmt=args.format, png_compression=args.png_compression)
 
 
 
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('data_dir', help='path pointing to the video directory')
-    parser.add_argument('-f', '--frequency', type=int, help='sampling rate in Hz', choices= [1, 10], default=10)
-    parser.add_argument('-r', '--recursive', help='search recursively for video directories that have video_left.avi as a child', action='store_true')
-    parser.add_argument('-j', '--jobs', help='number of parallel works to use when saving images', default=4, type=int)
-
-    SystemExit(main(parser.parse_args()))
\ No newline at end of file
+    parser = get_parser()
+    SystemExit(main(parser.parse_args()))
@@ -1,15 +1,16 @@
 import argparse
 import sys
-import scripts.evaluate as eval
-from scripts.generate_mock_predictions import main as main_g
-from scripts.sample_video import main as main_u
+
+# the modules of the commands are imported inside their branch, so every command
+# only loads the dependencies it uses
 
 def main ():
     parser = argparse.ArgumentParser(description="SAR-RARP50 cmd toolkit", usage="rarptk COMMAND [OPTIONS]")
-    parser.add_argument('command', help='specify command to run', choices=['evaluate', 'generate', 'unpack'])
+    parser.add_argument('command', help='specify command to run', choices=['evaluate', 'generate', 'unpack', 'pack', 'bench'])
     cmd_tool = parser.parse_args(sys.argv[1:2])
     print (cmd_tool.command)
     if cmd_tool.command == 'evaluate':
+        import scripts.evaluate as eval
         parser = eval.get_parser()
         args = parser.parse_args(sys.argv[2:])
         if (args.ignore_actions and args.ignore_segmentation):
@@ -18,21 +19,28 @@ def main ():
 
         
     elif cmd_tool.command == 'unpack':
-        parser = argparse.ArgumentParser()
-        parser.add_argument('data_dir', help='path pointing to the video or dataset directory')
-        parser.add_argument('-f', '--frequency', type=int, help='sampling rate in Hz', choices= [1, 10], default=10)
-        parser.add_argument('-r', '--recursive', help='search recursively for video directories that have video_left.avi as a child', action='store_true')
-        parser.add_argument('-j', '--jobs', help='number of parallel works to use when saving images', default=4, type=int)
+        from scripts.sample_video import main as main_u, get_parser as get_parser_u
+        parser = get_parser_u()
         args = parser.parse_args(sys.argv[2:])
         SystemExit(main_u(args))
         
     elif cmd_tool.command == 'generate':  
-        parser = argparse.ArgumentParser()
-        parser.add_argument('test_dir', help='root_directory of the test set')
-        parser.add_argument('prediction_dir', help='directory to store predictions')
-        parser.add_argument('-o','--overwrite', help='overwrite the predictions of prediction_dir', action='store_true')
+        from scripts.generate_mock_predictions import main as main_g, get_parser as get_parser_g
+        parser = get_parser_g()
         args = parser.parse_args(sys.argv[2:])
         SystemExit(main_g(args))
+
+    elif cmd_tool.command == 'pack':
+        from scripts.pack import main as main_p, get_parser as get_parser_p
+        parser = get_parser_p()
+        args = parser.parse_args(sys.argv[2:])
+        SystemExit(main_p(args))
+
+    elif cmd_tool.command == 'bench':
+        from scripts.bench import main as main_b, get_parser as get_parser_b
+        parser = get_parser_b()
+        args = parser.parse_args(sys.argv[2:])
+        SystemExit(main_b(args))
     else:
         raise NotImplementedError
     
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+from sarrarp50.metrics.action_recognition import _f1k, _f1k_curve, parse_action_file, score_action_set
+
+
+def reference_f1k(p, y, n_classes, bg_class=None, overlap=.1):
+    # the original segmental F1 loop, comparing every predicted segment against
+    # all true segments. _f1k must give exactly the same scores.
+    def segment_labels(Yi):
+        idxs = [0] + (np.nonzero(np.diff(Yi))[0] + 1).tolist() + [len(Yi)]
+        return np.array([Yi[idxs[i]] for i in range(len(idxs) - 1)])
+
+    def segment_intervals(Yi):
+        idxs = [0] + (np.nonzero(np.diff(Yi))[0] + 1).tolist() + [len(Yi)]
+        return [(idxs[i], idxs[i + 1]) for i in range(len(idxs) - 1)]
+
+    true_intervals = np.array(segment_intervals(y))
+    true_labels = segment_labels(y)
+    pred_intervals = np.array(segment_intervals(p))
+    pred_labels = segment_labels(p)
+
+    if bg_class is not None:
+        true_intervals = true_intervals[true_labels!=bg_class]
+        true_labels = true_labels[true_labels!=bg_class]
+        pred_intervals = pred_intervals[pred_labels!=bg_class]
+        pred_labels = pred_labels[pred_labels!=bg_class]
+
+    n_true = true_labels.shape[0]
+    n_pred = pred_labels.shape[0]
+    TP = np.zeros(n_classes, np.float64)
+    FP = np.zeros(n_classes, np.float64)
+    true_used = np.zeros(n_true, np.float64)
+
+    for j in range(n_pred):
+        intersection = np.minimum(pred_intervals[j,1], true_intervals[:,1]) - np.maximum(pred_intervals[j,0], true_intervals[:,0])
+        union = np.maximum(pred_intervals[j,1], true_intervals[:,1]) - np.minimum(pred_intervals[j,0], true_intervals[:,0])
+        IoU = (intersection / union)*(pred_labels[j]==true_labels)
+        if n_true == 0:
+            # the original loop failed here, every predicted segment is a false positive
+            FP[pred_labels[j]] += 1
+            continue
+        idx = IoU.argmax()
+        if IoU[idx] >= overlap and not true_used[idx]:
+            TP[pred_labels[j]] += 1
+            true_used[idx] = 1
+        else:
+            FP[pred_labels[j]] += 1
+
+    TP = TP.sum()
+    FP = FP.sum()
+    FN = n_true - true_used.sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = TP / (TP+FP)
+        recall = TP / (TP+FN)
+        F1 = 2 * (precision*recall) / (precision+recall)
+    return np.nan_to_num(F1)
+
+
+def random_labels(rng, n_classes=8):
+    # a reference sequence of random segments and a prediction with shifted
+    # boundaries and short bursts of random labels
+    n = int(rng.integers(1, 300))
+    y = np.repeat(rng.integers(0, n_classes, size=n), rng.integers(1, 30, size=n))[:int(rng.integers(1, 600))]
+    p = np.roll(y, int(rng.integers(-5, 6)))
+    for start in rng.integers(0, len(y), size=int(rng.integers(0, 20))):
+        p[start:start+int(rng.integers(1, 6))] = rng.integers(0, n_classes)
+    return p, y
+
+
+OVERLAPS = (.1, .25, .5, .75, 1.)
+
+@pytest.mark.parametrize('bg_class', [None, 0, 3])
+def test_f1k_matches_reference(bg_class):
+    rng = np.random.default_rng(0 if bg_class is None else bg_class+1)
+    for _ in range(500):
+        p, y = random_labels(rng)
+        for overlap in OVERLAPS:
+            assert _f1k(p, y, n_classes=8, bg_class=bg_class, overlap=overlap) == reference_f1k(p, y, 8, bg_class, overlap)
+        assert np.array_equal(_f1k_curve(p, y, OVERLAPS, n_classes=8, bg_class=bg_class),
+                              [reference_f1k(p, y, 8, bg_class, overlap) for overlap in OVERLAPS])
+
+
+@pytest.mark.parametrize('bg_class', [None, 0])
+def test_score_action_set_matches_reference(bg_class):
+    rng = np.random.default_rng(10 if bg_class is None else 11)
+    ks = [overlap*100 for overlap in OVERLAPS]
+    for _ in range(100):
+        preds, refs = zip(*[random_labels(rng) for _ in range(int(rng.integers(1, 6)))])
+        scores = score_action_set(preds, refs, ks=ks, n_classes=8, bg_class=bg_class)
+        for i, (p, y) in enumerate(zip(preds, refs)):
+            assert scores['accuracy'][i] == np.mean(p == y)
+            assert np.array_equal(scores['f1'][i], [reference_f1k(p, y, 8, bg_class, k/100) for k in ks])
+            confusion = np.zeros((8, 8), dtype=np.int64)
+            np.add.at(confusion, (y, p), 1)
+            assert np.array_equal(scores['confusion'][i], confusion)
+
+
+def test_parse_action_file_reports_out_of_range_values(tmp_path):
+    path = tmp_path/'action_discrete.txt'
+    path.write_text('000000000,6\n000000006,99999999999\n\n000000012,-2147483649\n000000018,2147483647\n')
+    with pytest.raises(ValueError, match="line 2: .*line 4: ") as e:
+        parse_action_file(path)
+    assert 'line 5' not in str(e.value)
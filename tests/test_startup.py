@@ -0,0 +1,9 @@
+import pytest
+from scripts.bench import bench_startup
+
+
+# rarptk COMMAND --help must not import any of scripts.bench.HEAVY_MODULES
+
+@pytest.mark.parametrize('command', ['evaluate', 'unpack', 'generate', 'pack', 'bench'])
+def test_help_does_not_import_heavy_modules(command):
+    bench_startup(command)